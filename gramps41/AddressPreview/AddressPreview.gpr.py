@@ -37,4 +37,5 @@ register(GRAMPLET,
          gramplet = 'AddressPreview',
          gramplet_title=_("AddressPreview"),
          navtypes=["Place"],
+         depends_on=["libplaceaddress"],
          )
@@ -1,21 +1,35 @@
 from __future__ import unicode_literals
 
+import os
+import logging
+import threading
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from gi.repository import Gtk
+from gi.repository import Gdk
+from gi.repository import GLib
+from gi.repository import GObject
+from gi.repository import GdkPixbuf
 
 from gramps.gen.plug import Gramplet
 from gramps.gui.widgets import Photo
+from gramps.gui.thumbnails import get_thumbnail_path, SIZE_NORMAL, SIZE_LARGE
+from gramps.gui.utils import find_mime_type_pixbuf
 from gramps.gen.const import GRAMPS_LOCALE as glocale
 
 from gramps.gen.utils.place import conv_lat_lon
 from gramps.gen.utils.file import media_path_full
-from gramps.gen.display.place import displayer as place_displayer
 from gi.repository import Gtk
 from gi.repository import Pango
-from gramps.gen.lib import PlaceType
-from gramps.gen.lib import Place
-from gramps.gen.utils.location import get_main_location
 from gramps.gui.dbguielement import DbGUIElement
-from gramps.gen.lib.date import Today
+
+from libplaceaddress import (PLACE_KEYS, DEFAULT_TEMPLATES, get_place_resolver,
+                             validate_template, compile_templates, render_address,
+                             lazy_place_address)
 
 try:
     trans = glocale.get_addon_translator(__file__)
@@ -23,36 +37,237 @@ except ValueError:
     trans = glocale.translation
 _ = trans.gettext
 
+LOG = logging.getLogger(".AddressPreview")
+
+# number of places whose rendered addresses are kept in memory
+_ADDRESS_CACHE_SIZE = 200
+
+# tells the thumbnail worker thread to exit
+_STOP_WORKER = None
+
+# display modes
+_MODE_PLACE = "place"
+_MODE_TABLE = "table"
+
 
 class AddressPreview(Gramplet, DbGUIElement):
     """
     Displays the participants of an event.
     """
     def __init__(self, gui, nav_group=0):
+        # place handle -> (title, address rows)
+        self._address_cache = OrderedDict()
+        # place handle -> handles of the place tree of the place
+        self._hierarchies = {}
+        # reverse index: handle of a place -> handles of the cached places
+        # that have it in their place tree
+        self._dependents = {}
+        self._active_handle = None
+        self._update_id = 0
+        self.display_mode = _MODE_PLACE
+        # address table model and the Place view model it was built from
+        self._table_model = None
+        self._source_model = None
+        # (object, handler id) of the signals watched for Place view changes
+        self._source_signals = []
+        self._address_templates = list(DEFAULT_TEMPLATES)
+        self._compiled_formats = compile_templates(self._address_templates)
+        # place resolver shared with the other users of the database
+        self._resolver = get_place_resolver(gui.dbstate.db)
+        # (path, modification time, rectangle) of the image being displayed
+        self._image_key = None
+        self._thumbnail_queue = None
+        # toplevel window watched for iconifying, and its handler id
+        self._toplevel = None
+        self._window_state_id = 0
+        # Gramplet.__init__ calls db_changed, which needs the callback manager
+        DbGUIElement.__init__(self, gui.dbstate.db)
         Gramplet.__init__(self, gui, nav_group)
-        DbGUIElement.__init__(self, self.dbstate.db)
+        self.connect_signal('Place', self.schedule_update)
 
     def _connect_db_signals(self):
         """
         called on init of DbGUIElement, connect to db as required.
         """
-        self.callman.register_callbacks({'place-update': self.changed,
-                                         'event-update': self.changed})
-        self.callman.connect_all(keys=['place', 'event'])
-        #self.dbstate.db.connect('person-update', self.update)
-        self.connect_signal('Place', self.update)
+        self.callman.register_callbacks({'place-add': self.added,
+                                         'place-update': self.changed,
+                                         'place-delete': self.deleted})
+        self.callman.connect_all(keys=['place'])
 
-    def changed(self, handle):
+    def added(self, handles):
         """
-        Called when a registered person is updated.
+        Called when places are added. Reloads the address table.
         """
+        if self.display_mode == _MODE_TABLE:
+            self._table_model = None
+            self.schedule_update()
+
+    def changed(self, handles):
+        """
+        Called when registered places are updated or deleted. Updates the
+        gramplet only if the places are in the place tree of the displayed
+        place.
+        """
+        affected = self.invalidate_addresses(handles)
+        if self.display_mode == _MODE_TABLE:
+            if affected:
+                self.address_view.queue_draw()
+        elif self._active_handle in affected:
+            self.schedule_update()
+
+    def deleted(self, handles):
+        """
+        Called when places are deleted.
+        """
+        if self.display_mode == _MODE_TABLE:
+            self.invalidate_addresses(handles)
+            self._table_model = None
+            self.schedule_update()
+        else:
+            self.changed(handles)
+
+    def schedule_update(self, *args):
+        """
+        Update the gramplet once when idle, however many times this is called
+        before that.
+        """
+        if not self._update_id:
+            self._update_id = GLib.idle_add(self._idle_update)
+
+    def _idle_update(self):
+        self._update_id = 0
         self.update()
+        return False
+
+    def invalidate_addresses(self, handles):
+        """
+        Remove cached addresses of the places that have any of the given
+        places in their place tree. Returns the handles of those places.
+        """
+        affected = set()
+        for handle in handles:
+            affected.update(self._dependents.get(handle, ()))
+        for place_handle in affected:
+            self._address_cache.pop(place_handle, None)
+            self._remove_dependencies(place_handle)
+        return affected
+
+    def _add_dependencies(self, place_handle, hierarchy):
+        """
+        Record the handles in the place tree of the place in the reverse
+        index.
+        """
+        self._remove_dependencies(place_handle)
+        self._hierarchies[place_handle] = hierarchy
+        for handle in hierarchy:
+            self._dependents.setdefault(handle, set()).add(place_handle)
+
+    def _remove_dependencies(self, place_handle):
+        for handle in self._hierarchies.pop(place_handle, ()):
+            dependents = self._dependents.get(handle)
+            if dependents is not None:
+                dependents.discard(place_handle)
+                if not dependents:
+                    del self._dependents[handle]
 
     def init(self):
         self.gui.WIDGET = self.build_gui()
+        self.address_view = self.build_table()
         self.gui.get_container_widget().remove(self.gui.textview)
-        self.gui.get_container_widget().add_with_viewport(self.gui.WIDGET)
+        self.viewport = Gtk.Viewport()
+        self.viewport.add(self.gui.WIDGET)
+        self.viewport.show()
+        self.gui.get_container_widget().add(self.viewport)
         self.gui.WIDGET.show()
+        self.gui.get_container_widget().connect('map', self._on_map)
+        self.gui.get_container_widget().connect('destroy', self._stop_thumbnail_worker)
+
+    def on_load(self):
+        if len(self.gui.data) > 0 and self.gui.data[0] in (_MODE_PLACE, _MODE_TABLE):
+            self.display_mode = self.gui.data[0]
+        if len(self.gui.data) == len(DEFAULT_TEMPLATES) + 1:
+            self.set_address_templates(self.gui.data[1:])
+
+    def build_options(self):
+        from gramps.gen.plug.menu import EnumeratedListOption, StringOption
+        mode = EnumeratedListOption(_("Display"), self.display_mode)
+        mode.add_item(_MODE_PLACE, _("Address of the active place"))
+        mode.add_item(_MODE_TABLE, _("Addresses of all places in the Place view"))
+        self.add_option(mode)
+        keys = ", ".join("%" + key for key in PLACE_KEYS)
+        for title, template in zip(self._address_rows, self._address_templates):
+            option = StringOption(title, template)
+            option.set_help(_("Address template. Available keys: %s") % keys)
+            self.add_option(option)
+
+    def save_options(self):
+        self.display_mode = self.get_option(_("Display")).get_value()
+        templates = [self.get_option(title).get_value()
+                     for title in self._address_rows[:len(DEFAULT_TEMPLATES)]]
+        self.set_address_templates(templates)
+        self.gui.data = [self.display_mode] + self._address_templates
+
+    def set_address_templates(self, templates):
+        """
+        Validate and compile the address templates. Invalid templates are
+        replaced with the default ones. Cached addresses are cleared if any
+        template has changed.
+        """
+        valid_templates = []
+        for template, default in zip(templates, DEFAULT_TEMPLATES):
+            if not validate_template(template):
+                LOG.warning("Unbalanced brackets in address template %r, using %r",
+                            template, default)
+                template = default
+            valid_templates.append(template)
+        if valid_templates == self._address_templates:
+            return
+        self._address_templates = valid_templates
+        self._compiled_formats = compile_templates(valid_templates)
+        self._address_cache.clear()
+        self._hierarchies.clear()
+        self._dependents.clear()
+        self.address_view.queue_draw()
+
+    def build_table(self):
+        """
+        Build the view for the address table mode. Rows have fixed height,
+        so that only the rows scrolled into view are rendered.
+        """
+        view = Gtk.TreeView()
+        view.set_fixed_height_mode(True)
+        titles = [_("Place")] + self._address_rows[:6]
+        for index, title in enumerate(titles):
+            column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text=index)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(150)
+            column.set_resizable(True)
+            view.append_column(column)
+        view.connect('row-activated', self._table_row_activated)
+        view.show()
+        return view
+
+    def _table_row_activated(self, view, path, column):
+        handle = self._table_model.get_handle(path.get_indices()[0])
+        if handle:
+            self.set_active('Place', handle)
+
+    def set_display_mode(self, mode):
+        """
+        Show the widget of the display mode in the gramplet.
+        """
+        container = self.gui.get_container_widget()
+        widget = self.address_view if mode == _MODE_TABLE else self.viewport
+        child = container.get_child()
+        if child is not widget:
+            if child is not None:
+                container.remove(child)
+            container.add(widget)
+            if mode != _MODE_TABLE:
+                self._disconnect_source()
+                self._table_model = None
+                self._source_model = None
+                self.address_view.set_model(None)
 
     def build_gui(self):
         """
@@ -65,7 +280,17 @@ class AddressPreview(Gramplet, DbGUIElement):
         self.title.set_alignment(0, 0)
         self.title.modify_font(Pango.FontDescription('sans bold 12'))
         vbox.pack_start(self.title, False, True, 7)
-        self.table = Gtk.Table(n_rows=1, n_columns=2)
+        self.table = Gtk.Table(n_rows=len(self._address_rows), n_columns=2)
+        self.rows = []
+        for row, title in enumerate(self._address_rows):
+            label = Gtk.Label(label=title + ':')
+            label.set_alignment(1, 0)
+            value = Gtk.Label()
+            value.set_alignment(0, 0)
+            self.table.attach(label, 0, 1, row, row + 1, xoptions=Gtk.AttachOptions.FILL,
+                                                         xpadding=10)
+            self.table.attach(value, 1, 2, row, row + 1)
+            self.rows.append((label, value))
         vbox.pack_start(self.table, False, True, 0)
         self.top.pack_start(self.photo, False, True, 5)
         self.top.pack_start(vbox, False, True, 10)
@@ -74,38 +299,8 @@ class AddressPreview(Gramplet, DbGUIElement):
 
 # ------------------------------------------------------------------------------------------
 
-    _address_format = ["street, custom, unknown, building, department, farm, neighborhood",
-                       "hamlet, village, borough, locality",
-                       "code[ town, city, municipality], parish",
-                       "district, region, province, county, state",
-                       "country",
-                       ""]
-
-    _place_keys = ['street', 'department', 'building', 'farm', 'neighborhood', 'hamlet', 'village',
-                  'borough', 'locality', 'town', 'city', 'municipality', 'parish', 'district',
-                  'region', 'province', 'county', 'state', 'country', 'custom', 'unknown', 'code']
-
-    _place_types = dict(street=PlaceType.STREET,
-                       department=PlaceType.DEPARTMENT,
-                       building=PlaceType.BUILDING,
-                       farm=PlaceType.FARM,
-                       neighborhood=PlaceType.NEIGHBORHOOD,
-                       hamlet=PlaceType.HAMLET,
-                       village=PlaceType.VILLAGE,
-                       borough=PlaceType.BOROUGH,
-                       locality=PlaceType.LOCALITY,
-                       town=PlaceType.TOWN,
-                       city=PlaceType.CITY,
-                       municipality=PlaceType.MUNICIPALITY,
-                       parish=PlaceType.PARISH,
-                       district=PlaceType.DISTRICT,
-                       province=PlaceType.PROVINCE,
-                       region=PlaceType.REGION,
-                       county=PlaceType.COUNTY,
-                       state=PlaceType.STATE,
-                       country=PlaceType.COUNTRY,
-                       custom=PlaceType.CUSTOM,
-                       unknown=PlaceType.UNKNOWN)
+    _address_rows = [_("Address 1"), _("Address 2"), _("City"), _("State"),
+                     _("Country"), _("Postal Code"), _("Version")]
 
     def add_row(self, title, value):
         """
@@ -124,38 +319,103 @@ class AddressPreview(Gramplet, DbGUIElement):
                                                        xpadding=10)
         self.table.attach(value, 1, 2, rows, rows + 1)
 
+    def set_address_rows(self, values):
+        """
+        Set the texts of the address rows, hiding rows without text.
+        """
+        for (label, value_label), value in zip(self.rows, values):
+            if value:
+                if value_label.get_text() != value:
+                    value_label.set_text(value)
+                label.show()
+                value_label.show()
+            else:
+                label.hide()
+                value_label.hide()
+
     def clear_table(self):
         """
-        Remove all the rows from the table.
+        Hide the address rows and remove all the other rows from the table.
         """
-        list(map(self.table.remove, self.table.get_children()))
-        self.table.resize(1, 2)
+        fixed = set(widget for row in self.rows for widget in row)
+        for child in self.table.get_children():
+            if child not in fixed:
+                self.table.remove(child)
+        self.table.resize(len(self.rows), 2)
+        self.set_address_rows([""] * len(self.rows))
 
     def db_changed(self):
-        self.dbstate.db.connect('place-update', self.update)
-        self.connect_signal('Place', self.update)
+        self._address_cache.clear()
+        self._hierarchies.clear()
+        self._dependents.clear()
+        self._active_handle = None
+        self._resolver = get_place_resolver(self.dbstate.db)
+        if self.callman.database is not self.dbstate.db:
+            self._change_db(self.dbstate.db)
+
+    def update(self, *args):
+        """
+        Skip updating while the gramplet can't be seen, e.g. in a hidden
+        sidebar tab or in an iconified detached window. The gramplet is
+        updated when it is shown again.
+        """
+        if self.active and not self.gui.force_update and not self.is_shown():
+            self.dirty = True
+            return
+        Gramplet.update(self, *args)
+
+    def is_shown(self):
+        """
+        Return True if the gramplet is mapped in a window that isn't iconified.
+        """
+        widget = self.gui.get_container_widget()
+        if not widget.get_mapped():
+            return False
+        window = widget.get_toplevel().get_window()
+        return not (window and window.get_state() & Gdk.WindowState.ICONIFIED)
+
+    def _on_map(self, widget):
+        toplevel = widget.get_toplevel()
+        if toplevel is not self._toplevel:
+            if self._window_state_id:
+                self._toplevel.disconnect(self._window_state_id)
+            self._toplevel = toplevel
+            self._window_state_id = toplevel.connect('window-state-event',
+                                                     self._on_window_state)
+        if self.dirty:
+            self.update()
+
+    def _on_window_state(self, window, event):
+        if (event.changed_mask & Gdk.WindowState.ICONIFIED
+                and not event.new_window_state & Gdk.WindowState.ICONIFIED
+                and self.dirty):
+            self.update()
+        return False
 
     def update_has_data(self):
-        active_handle = self.get_active('Person')
-        if active_handle:
-            active_person = self.dbstate.db.get_person_from_handle(active_handle)
-            self.set_has_data(active_person is not None)
-        else:
-            self.set_has_data(False)
+        """
+        Called instead of main() while the gramplet isn't active, so it only
+        checks that the active place exists.
+        """
+        active_handle = self.get_active('Place')
+        self.set_has_data(bool(active_handle) and
+                          self.dbstate.db.has_place_handle(active_handle))
 
     def main(self):
-        self.display_empty()
+        self.set_display_mode(self.display_mode)
+        if self.display_mode == _MODE_TABLE:
+            self.display_table()
+            return
+
         active_handle = self.get_active('Place')
+        place = None
         if active_handle:
             place = self.dbstate.db.get_place_from_handle(active_handle)
-            self.top.hide()
-            if place:
-                self.display_place(place)
-                self.set_has_data(True)
-            else:
-                self.set_has_data(False)
-            self.top.show()
+        if place:
+            self.display_place(place)
+            self.set_has_data(True)
         else:
+            self.display_empty()
             self.set_has_data(False)
 
     def display_place(self, place):
@@ -163,28 +423,11 @@ class AddressPreview(Gramplet, DbGUIElement):
         Display details of the active place.
         """
         self.load_place_image(place)
-        title = place_displayer.display(self.dbstate.db, place)
-        self.title.set_text(title)
-        self.clear_table()
-
-        #parser = FormatStringParser(self._place_keys)
-        place_dict = self.generate_place_dictionary(place)
-        parser = FormatStringParser(place_dict)
-
-        addr1 = parser.parse(place_dict, self._address_format[0])
-        addr2 = parser.parse(place_dict, self._address_format[1])
-        city = parser.parse(place_dict, self._address_format[2])
-        state = parser.parse(place_dict, self._address_format[3])
-        country = parser.parse(place_dict, self._address_format[4])
-        code = parser.parse(place_dict, self._address_format[5])
-
-        self.add_row(_("Address 1"), addr1)
-        self.add_row(_("Address 2"), addr2)
-        self.add_row(_("City"), city)
-        self.add_row(_("State"), state)
-        self.add_row(_("Country"), country)
-        self.add_row(_("Postal Code"), code)
-        self.add_row(_("Version"), "0.1")
+        title, rows = self.get_address(place)
+        self._active_handle = place.handle
+        if self.title.get_text() != title:
+            self.title.set_text(title)
+        self.set_address_rows(rows)
 
         #self.add_row(_('Name'), place.get_name())
         #self.add_row(_('Type'), place.get_type())
@@ -199,24 +442,123 @@ class AddressPreview(Gramplet, DbGUIElement):
         #if lon:
         #    self.add_row(_('Longitude'), lon)
 
-    def generate_place_dictionary(self, place):
-        db = self.dbstate.get_database()
-        location = get_main_location(db, place)
-        place_dict = dict()
-
-        for key in self._place_keys:
-            place_type = self._place_types.get(key.lower())
-            if place_type:
-                value = location.get(place_type)
-            elif key == "code":
-                value = place.get_code()
-            else:
-                value = ""
-            if not value: value = ""
+    def display_table(self):
+        """
+        Display addresses of all the places in the Place view. The place
+        list is reloaded when the Place view has been rebuilt, e.g. with
+        another filter.
+        """
+        page = self.get_place_view()
+        source_model = getattr(page, 'model', None)
+        if self._table_model is None or source_model is not self._source_model:
+            self._disconnect_source()
+            self._source_model = source_model
+            self._table_model = AddressTableModel(self.get_filtered_place_handles(source_model),
+                                                  self.get_table_row, 7)
+            self.address_view.set_model(self._table_model)
+            self._connect_source(page, source_model)
+        self.set_has_data(len(self._table_model) > 0)
+
+    def get_place_view(self):
+        """
+        Return the Place view if it is the active view.
+        """
+        viewmanager = getattr(self.uistate, 'viewmanager', None)
+        page = getattr(viewmanager, 'active_page', None)
+        if page is not None and page.navigation_type() == 'Place':
+            return page
+        return None
 
-            place_dict[key] = value
-        return place_dict
+    def get_filtered_place_handles(self, model):
+        """
+        Return the handles of the places shown in the Place view model, read
+        from the model as the rows are displayed, or handles of all the
+        places if there is no model.
+        """
+        if model is None:
+            return list(self.dbstate.db.iter_place_handles())
+        return PlaceViewRows(model)
+
+    def _connect_source(self, page, model):
+        """
+        Watch the Place view for changes of the places it shows. The view
+        sets a new model when it is rebuilt, e.g. with another filter.
+        """
+        tree_view = getattr(page, 'list', None)
+        if tree_view is not None:
+            self._source_signals.append(
+                (tree_view, tree_view.connect('notify::model', self._source_rebuilt)))
+        if model is not None:
+            for name in ('row-inserted', 'row-deleted', 'rows-reordered'):
+                self._source_signals.append(
+                    (model, model.connect(name, self._source_rebuilt)))
+            self._source_signals.append(
+                (model, model.connect('row-changed', self._source_row_changed)))
 
+    def _disconnect_source(self):
+        for source, handler_id in self._source_signals:
+            source.disconnect(handler_id)
+        self._source_signals = []
+
+    def _source_rebuilt(self, *args):
+        """
+        Reload the address table once the Place view has settled.
+        """
+        self._table_model = None
+        self.schedule_update()
+
+    def _source_row_changed(self, *args):
+        self.address_view.queue_draw()
+
+    def get_table_row(self, handle):
+        """
+        Return place title and address fields of a row in the address table.
+        """
+        cached = self._address_cache.get(handle)
+        if cached is None:
+            place = self.dbstate.db.get_place_from_handle(handle)
+            if place is None:
+                return ("",) * 7
+            cached = self.get_address(place)
+        title, rows = cached
+        return (title,) + tuple(rows[:6])
+
+    def get_address(self, place):
+        """
+        Return title and address rows of the place, from the cache if the
+        place has been displayed before.
+        """
+        cached = self._address_cache.pop(place.handle, None)
+        if cached is None:
+            cached = self.render_address(place)
+        self._address_cache[place.handle] = cached
+        if len(self._address_cache) > _ADDRESS_CACHE_SIZE:
+            handle, evicted = self._address_cache.popitem(last=False)
+            self._remove_dependencies(handle)
+        return cached
+
+    def render_address(self, place):
+        """
+        Render title and texts of the address rows of the place. The places
+        in the place tree are recorded as dependencies of the cached title
+        and address, whichever keys the templates use.
+        """
+        hierarchy = self._resolver.resolve(place).hierarchy
+        self._add_dependencies(place.handle, frozenset(handle for handle, name, place_type in hierarchy))
+        title = self._resolver.get_title(place)
+
+        values = lazy_place_address(place, self._resolver.get_address)
+        return title, render_address(values, self._compiled_formats) + ("0.8.1",)
+
+    def get_place_hierarchy(self, place):
+        """
+        Return (handle, name, type) of the place and all the places above it
+        in the place tree, like get_location_list does.
+        """
+        return self._resolver.get_hierarchy(place)
+
+    def get_place_address(self, place):
+        return self._resolver.get_address(place)
 
     def display_alt_names(self, place):
         """
@@ -230,10 +572,10 @@ class AddressPreview(Gramplet, DbGUIElement):
         """
         Display empty details when no repository is selected.
         """
-        self.photo.set_image(None)
-        self.photo.set_uistate(None, None)
+        self.clear_image()
         self.title.set_text('')
         self.clear_table()
+        self._active_handle = None
 
     def display_separator(self):
         """
@@ -259,398 +601,219 @@ class AddressPreview(Gramplet, DbGUIElement):
             full_path = media_path_full(self.dbstate.db, obj.get_path())
             mime_type = obj.get_mime_type()
             if mime_type and mime_type.startswith("image"):
-                self.photo.set_image(full_path, mime_type,
-                                     media_ref.get_rectangle())
+                self.load_thumbnail(full_path, mime_type,
+                                    media_ref.get_rectangle())
                 self.photo.set_uistate(self.uistate, object_handle)
             else:
-                self.photo.set_image(None)
-                self.photo.set_uistate(None, None)
-        else:
-            self.photo.set_image(None)
-            self.photo.set_uistate(None, None)
-
-#!/usr/bin/python
-#
-# FORMAT STRING PARSER
-# v0.1
-#
-# Parses format string with key coded values in dictionary removing unnecessary separators between parsed names
-#
-# (C) 2015  Kati Haapamaki
-#
-# ToDo:
-# escape char handling
-# methods to change default encloser chars
-# | option
-
-class ElementType():
-    KEY = 1
-    SEPARATOR = 2
-    PREFIX = 3
-    SUFFIX = 4
-    PARSED = 0
-    PLAINTEXT = 5
-
-
-class ParseMode():
-    ALWAYS = 0
-    IFANY = 1
-    IFALL = 2
-
-
-class FormatStringParser():
-
-    _all_keys = []
-    _ec_any_start = '['
-    _ec_any_end = ']'
-    _ec_all_start = '<'
-    _ec_all_end = '>'
-    _ec_always_start = '{'
-    _ec_always_end = '}'
-    _escape = '\\'
-
-    def __init__(self, key_list):
-        self._all_keys = []
-        if type(key_list) is list:
-            self._all_keys = key_list
-        elif type(key_list) is dict:
-            for key, value in key_list.items():
-                self._all_keys.append(key)
+                self.clear_image()
         else:
-            raise TypeError("Incorrect key list type")
-
-    def parse(self, values, format_string):
-        parsed_list = self._parse_full_format_string(values, format_string)
-        print(parsed_list)
-        return self._make_string_from_list(parsed_list)
-
-    def _parse_full_format_string(self, values, format_string, mode=ParseMode.IFANY):
-        """
-        Recurses format string's enclosed parts, and parses them into tuple list.
-        Returns tuple list of elements of partial format string when going thru recursion
-        Finally returns tuple list that is suppressed to single item including the full parsed string
-
-        :param values:
-        :param format_string:
-        :param mode:
-        :return:
-        """
-        encloser_start = self._find_encloser_start(format_string)
-        if encloser_start:
-            start_pos = encloser_start[0]
-
-            if start_pos >= 0:
-                encloser_end = self._find_encloser_end(format_string, encloser_start)
-                if encloser_end:
-                    end_pos = encloser_end[0]
-                    enclosed_mode = encloser_end[1]
-                    before = middle = after = ""
-                    if end_pos - start_pos >= 2:
-                        middle = format_string[start_pos + 1:end_pos]
-                    if start_pos > 0:
-                        before = format_string[:start_pos]
-                    if end_pos < len(format_string) - 1:
-                        after = format_string[end_pos + 1:]
-
-                    recursion = self._collect(
-                        self._parse_full_format_string(values, before, mode)
-                        + self._collect(self._parse_full_format_string(values, middle, enclosed_mode), enclosed_mode)
-                        + self._parse_full_format_string(values, after, mode))
-
-                    return recursion
-
-        new_tuple_list = self._collect(self._parse_format_into_list(values, format_string))
-
-        return new_tuple_list
-
-
-    def _split_format_string_into_tuple_list(self, format_string, separator_mode=False):
-        """
-        :param format_string:
-        :return:
-        """
-
-        tuple_list = []
-        remainder = format_string
-        any_key_found = False
-        if remainder:
-            while remainder:
-                next_key = self._get_next_key(remainder)
-                if next_key:
-                    before, key, after = remainder.partition(next_key)
-                    if before:
-                        if any_key_found or separator_mode:
-                            separator_tuple = (before, ElementType.SEPARATOR)
-                        else:
-                            separator_tuple = (before, ElementType.PREFIX)
-                        tuple_list.append(separator_tuple)
-
-                    key_tuple = (key, ElementType.KEY)
-                    tuple_list.append(key_tuple)
-                    any_key_found = True
-                    remainder = after
-                else:
-                    if any_key_found and not separator_mode:
-                        separator_tuple = (remainder, ElementType.SUFFIX)
-                    else:
-
-                        separator_tuple = (remainder, ElementType.PLAINTEXT)
-                    tuple_list.append(separator_tuple)
-                    remainder = ""
-
-        return tuple_list
-
-    def _get_next_key(self, format_string):
-        """
-        Searches for the first valid key in a format string, returns the key if found
-        If found key formatted in uppercase, return key will be also uppercase
-
-        :param format_string:
-        :return:
-        """
-        any_found = False
-        lowest_index = -1
-        found_key = ""
-
-        if format_string:
-            for key in self._all_keys:
-                pos_lc = format_string.find(key, 0)
-                if pos_lc >= 0 and (pos_lc < lowest_index or not any_found):
-                    lowest_index = pos_lc
-                    any_found = True
-                    found_key = key
-                pos_uc = format_string.find(key.upper(), 0)
-                if pos_uc >= 0 and (pos_uc < lowest_index or not any_found):
-                    lowest_index = pos_uc
-                    any_found = True
-                    found_key = key.upper()
-        return found_key
-
-    def _parse_keys_in_list(self, values, tuple_list):
-        """
-        Parses keys in list
-
-        :param values: dictionary
-        :param tuple_list: elements of format string
-        :return:
-        """
-        if len(tuple_list) < 1:
-            return []
-        new_list = []
-        index = 0
-
-        for item, item_type in tuple_list:
-            if item_type is not ElementType.KEY:
-                replacement = (item, item_type)
-                new_list.append(replacement)
-            if item_type is ElementType.KEY:
-                value = values.get(item.lower())
-
-                if not value:
-                    value = ""
-
-                if item.isupper():
-                    replacement = (value.upper(), ElementType.PARSED)
-                else:
-                    replacement = (value, ElementType.PARSED)
-                new_list.append(replacement)
-
-            index += 1
-
-        return new_list
-
-    def _make_string_from_list(self, tuple_list):
-        str_list = []
-        for item, mode in tuple_list:
-            str_list.append(item)
-        return "".join(str_list)
-
-    def _collect(self, tuple_list, mode=ParseMode.IFANY):
-        """
-        Suppresses a tuple list to length of 1, disregarding empty parsed strings and separators between them
-
-        :param tuple_list:
-        :return:
-        """
-        string_list = []
-        index = 0
-        any_parsed = False
-
-        tuple_list = self._fix_separators(tuple_list)
-
-        for item, item_type in tuple_list:
-            if item_type == ElementType.PARSED:
-                any_parsed = True
-
-            if (item_type == ElementType.PARSED or item_type == ElementType.PLAINTEXT) and item:
-                string_list.append(item)
+            self.clear_image()
 
-                separator1 = None
-                separator2 = None
-                found_more = False
-
-                if len(tuple_list) > index + 2:
-                    if tuple_list[index+1][1] == ElementType.SEPARATOR:
-                        separator1 = tuple_list[index + 1]
-                    index2 = index + 1
-                    for item2, type2 in tuple_list[index+1:]:
-                        if (type2 == ElementType.PARSED or type2 == ElementType.PLAINTEXT) and item2:
-                            found_more = True
-                            if index2 > index + 2 and tuple_list[index2 - 1][1] == ElementType.SEPARATOR:
-                                separator2 = tuple_list[index2 - 1]
-                            break
-                        index2 += 1
-
-                    separator = separator2 if not separator1 else separator1
-
-                    if separator and found_more:
-                        string_list.append(separator[0])
-
-            elif item_type == ElementType.SEPARATOR:
-                pass
-
-            elif item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX:
-                string_list.append(item)
-
-            index += 1
+    def clear_image(self):
+        self._image_key = None
+        self.photo.set_image(None)
+        self.photo.set_uistate(None, None)
 
-        parsed_items = self._number_of_non_empty_parsed_item(tuple_list)
-        empty_items = self._number_of_empty_parsed_item(tuple_list)
+    def load_thumbnail(self, full_path, mime_type, rectangle):
+        """
+        Load and scale the image in a worker thread, and show it when ready.
+
+        Scaled thumbnails are cached on disk by the Gramps thumbnail cache,
+        which is keyed by path and rectangle and refreshed when the image
+        file is modified, so repeated visits skip decoding the full image.
+        """
+        try:
+            mtime = os.path.getmtime(full_path)
+        except OSError:
+            mtime = None
+        key = (full_path, mtime, tuple(rectangle) if rectangle else None)
+        if key == self._image_key:
+            return
+        self._image_key = key
+        if self._thumbnail_queue is None:
+            self._thumbnail_queue = queue.Queue()
+            worker = threading.Thread(target=self._thumbnail_worker,
+                                      args=(self._thumbnail_queue,))
+            worker.daemon = True
+            worker.start()
+        if self.uistate.screen_height() < 1000:
+            size = SIZE_NORMAL
+        else:
+            size = SIZE_LARGE
+        self._thumbnail_queue.put((key, mime_type, size))
+
+    def _stop_thumbnail_worker(self, *args):
+        """
+        Let the thumbnail worker thread exit when the gramplet is closed.
+        """
+        if self._thumbnail_queue is not None:
+            self._thumbnail_queue.put(_STOP_WORKER)
+            self._thumbnail_queue = None
+
+    def _thumbnail_worker(self, thumbnail_queue):
+        """
+        Load thumbnails requested by load_thumbnail. Runs in a worker thread
+        and must not touch any widgets, so only the thumbnail file is loaded
+        here, and a missing thumbnail is replaced with an icon in
+        _set_thumbnail.
+        """
+        while True:
+            request = thumbnail_queue.get()
+            if request is _STOP_WORKER:
+                return
+            key, mime_type, size = request
+            if key != self._image_key:
+                continue    # another image has been requested meanwhile
+            full_path, mtime, rectangle = key
+            try:
+                path = get_thumbnail_path(full_path, mime_type, rectangle, size)
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            except (GLib.GError, OSError):
+                pixbuf = None
+            GLib.idle_add(self._set_thumbnail, key, mime_type, pixbuf)
+
+    def _set_thumbnail(self, key, mime_type, pixbuf):
+        """
+        Show the loaded thumbnail, unless another image has been requested
+        meanwhile. Runs in the main thread.
+        """
+        if key == self._image_key:
+            self.photo.full_path = key[0]
+            if pixbuf is None and mime_type:
+                pixbuf = find_mime_type_pixbuf(mime_type)
+            if pixbuf:
+                self.photo.photo.set_from_pixbuf(pixbuf)
+                self.photo.photo.show()
+            else:
+                self.photo.photo.hide()
+        return False
 
-        if mode == ParseMode.ALWAYS:
-            print(string_list)
+class PlaceViewRows(object):
+    """
+    Sequence of the place handles shown in a Place view model. The number of
+    rows is taken from the model when created, and handles are only read
+    from the model when their rows are asked for.
 
-        if mode == ParseMode.IFANY and parsed_items > 0 \
-                or mode == ParseMode.ALWAYS \
-                or mode == ParseMode.IFALL and parsed_items > 0 and empty_items == 0:
+    Rows of list models are looked up by their position. The rows of tree
+    models are walked in display order as far as the rows asked for.
+    """
 
-            parsed_string = "".join(string_list)
+    def __init__(self, model):
+        self.model = model
+        self._list_only = bool(model.get_flags() & Gtk.TreeModelFlags.LIST_ONLY)
+        if self._list_only or not hasattr(model, 'displayed'):
+            self._length = model.iter_n_children(None)
         else:
-            parsed_string = ""
+            self._length = model.displayed()
+        self._handles = []
+        self._walk = None if self._list_only else self._iter_tree(None)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if self._list_only:
+            tree_iter = self.model.iter_nth_child(None, index)
+            if tree_iter is None:
+                return None
+            return self.model.get_handle_from_iter(tree_iter)
+        while self._walk is not None and len(self._handles) <= index:
+            handle = next(self._walk, None)
+            if handle is None:
+                self._walk = None
+            else:
+                self._handles.append(handle)
+        if index < len(self._handles):
+            return self._handles[index]
+        return None
+
+    def _iter_tree(self, parent):
+        tree_iter = self.model.iter_children(parent)
+        while tree_iter is not None:
+            handle = self.model.get_handle_from_iter(tree_iter)
+            if handle:
+                yield handle
+            for handle in self._iter_tree(tree_iter):
+                yield handle
+            tree_iter = self.model.iter_next(tree_iter)
+
+
+class AddressTableModel(GObject.GObject, Gtk.TreeModel):
+    """
+    List model of place addresses. Only the handles are stored, and rows
+    are rendered with get_row when the view asks for their values, i.e.
+    when they are scrolled into view. The number of rows is fixed when the
+    model is created.
+    """
 
-        return[(parsed_string, ElementType.PARSED if any_parsed else ElementType.PLAINTEXT)]
+    def __init__(self, handles, get_row, n_columns):
+        GObject.GObject.__init__(self)
+        self.handles = handles
+        self.get_row = get_row
+        self.n_columns = n_columns
+        self._length = len(handles)
 
-    def _fix_separators(self, tuple_list):
-        """
-        Should be used to convert suffixes and prefixes that orgin from enclosed parts of format string
-        into separators. Must be done before collect/suppress. Working ok?
+    def __len__(self):
+        return self._length
 
-        :param tuple_list:
-        :return:
+    def get_handle(self, index):
         """
-        index = 0
-        new_tuple_list = []
-        for item, item_type in tuple_list:
-            if index > 0 and index < (len(tuple_list) - 1) \
-                    and (item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX):
-                new_tuple = item, ElementType.SEPARATOR
-            else:
-                new_tuple = item, item_type
-            new_tuple_list.append(new_tuple)
-            index += 1
-        return new_tuple_list
-
-
-    def _number_of_empty_parsed_item(self, tuple_list):
+        Return the place handle of the row, or None if there is none.
         """
+        if 0 <= index < self._length:
+            return self.handles[index]
+        return None
 
-        :param tuple_list:
-        :return:
-        """
-        counter = 0
-        for item, item_type in tuple_list:
-            if item_type == ElementType.PARSED and not item:
-                counter += 1
-        return counter
+    def _new_iter(self, index):
+        tree_iter = Gtk.TreeIter()
+        tree_iter.user_data = index + 1     # zero would be a null pointer
+        return tree_iter
 
-    def _number_of_non_empty_parsed_item(self, tuple_list):
-        """
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
 
-        :param tuple_list:
-        :return:
-        """
-        counter = 0
-        for item, item_type in tuple_list:
-            if item_type == ElementType.PARSED and item:
-                counter += 1
-        return counter
+    def do_get_n_columns(self):
+        return self.n_columns
 
-    def _parse_format_into_list(self, values, format_string):
-        """
-        Splits format string into tuple list, and then parses keys included in it
+    def do_get_column_type(self, index):
+        return str
 
-        :param values:
-        :param format_string:
-        :return:
-        """
-        tuple_list = self._split_format_string_into_tuple_list(format_string)
-        parsed_list = self._parse_keys_in_list(values, tuple_list)
-        return parsed_list
+    def do_get_iter(self, path):
+        index = path.get_indices()[0]
+        if index < self._length:
+            return True, self._new_iter(index)
+        return False, None
 
-    def _find_encloser_start(self, format_string, start_pos=0):
-        index = start_pos
-        found_encloser = None
-        for c in format_string[start_pos:]:
-            if c == self._ec_any_start:
-                found_encloser = index, ParseMode.IFANY
-            elif c == self._ec_all_start:
-                found_encloser = index, ParseMode.IFALL
-            elif c == self._ec_always_start:
-                found_encloser = index, ParseMode.ALWAYS
-            if found_encloser and index > start_pos:
-                if format_string[index-1] == self._escape:
-                    found_encloser = None # flush found encloser if it's follower by escape char
-                else:
-                    break
-            index += 1
+    def do_get_path(self, tree_iter):
+        return Gtk.TreePath((tree_iter.user_data - 1,))
 
-        return found_encloser
+    def do_get_value(self, tree_iter, column):
+        handle = self.get_handle(tree_iter.user_data - 1)
+        if not handle:
+            return ""
+        return self.get_row(handle)[column]
 
-    def _find_encloser_end(self, format_string, encloser_start):
-        start_pos = encloser_start[0] + 1
-        found_encloser_end = None
+    def do_iter_next(self, tree_iter):
+        if tree_iter.user_data < self._length:
+            tree_iter.user_data += 1
+            return True
+        return False
 
-        if len(format_string)- start_pos > 1:
+    def do_iter_children(self, parent):
+        return self.do_iter_nth_child(parent, 0)
 
-            mode = encloser_start[1]
-            if mode == ParseMode.IFALL:
-                ec_end_char = self._ec_all_end
-            elif mode == ParseMode.ALWAYS:
-                ec_end_char = self._ec_always_end
-            else:
-                ec_end_char = self._ec_any_end
-
-            index = start_pos
-            level = 0
-            for c in format_string[start_pos:]:
-                if self._is_encloser_end_char(c):
-                    if level == 0 and c == ec_end_char:
-                        found_encloser_end = index, mode
-                        break
-                    else:
-                        level -= 1
-                        if index > start_pos:
-                            if format_string[index-1] == self._escape:
-                                level += 1 # was escape, step back
-                elif self._is_encloser_start_char(c):
-                    level += 1
-                    if index > start_pos:
-                        if format_string[index-1] == self._escape:
-                            level -= 1 # was escape, step back
-
-                index += 1
-
-        return found_encloser_end
-
-    def _is_encloser_start_char(self, c):
-        if not c:
-            return False
-        return c == self._ec_all_start or c == self._ec_any_start or c == self._ec_always_start
+    def do_iter_has_child(self, tree_iter):
+        return False
 
-    def _is_encloser_end_char(self, c):
-        if not c:
-            return False
-        return c == self._ec_all_end or c == self._ec_any_end or c == self._ec_always_end
+    def do_iter_n_children(self, tree_iter):
+        if tree_iter is None:
+            return self._length
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and n < self._length:
+            return True, self._new_iter(n)
+        return False, None
 
-    def _is_encloser_char(self, c):
-        return self._is_encloser_start_char(c) or self._is_encloser_end_char(c)
+    def do_iter_parent(self, child):
+        return False, None
@@ -40,5 +40,6 @@ register(EXPORT,
     export_options = 'GedcomWriterOptionBox',
     export_options_title = _('GEDCOM Options'),
     extension = "ged",
+    depends_on = ["libplaceaddress"],
 )
 
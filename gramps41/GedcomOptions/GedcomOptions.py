@@ -38,6 +38,14 @@ Names:
     (not implemented)
     Optional: Move patronymic surnames in the end of forenames
 
+Memory:
+    In streaming mode people and families are read one at a time, so their
+    number doesn't affect memory use. Places are different: the place table
+    (name, type, enclosing place and coordinates), the index of dated place
+    references and the aggregated coordinates have an entry per place, so
+    memory use grows with the number of places. Place objects and converted
+    coordinates are kept in bounded caches.
+
 """
 #------------------------------------------------------------------------
 #
@@ -46,6 +54,25 @@ Names:
 #------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import logging
+import heapq
+import tempfile
+from bisect import bisect_right, insort
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
 from gi.repository import Gtk
 
 from gramps.plugins.export import exportgedcom
@@ -55,13 +82,15 @@ from gramps.gen.lib import (AttributeType, ChildRefType, Citation, Date,
                             PlaceType, NoteType, Person, UrlType,
                             SrcAttributeType, NameOriginType)
 
+from gramps.gen.config import config
 from gramps.gen.errors import DatabaseError
 from gramps.gui.plug.export import WriterOptionBox
 from gramps.gen.utils.place import conv_lat_lon
-from gramps.gen.utils.location import get_main_location
-from gramps.gen.display.place import displayer as place_displayer
 from gramps.gen.lib.date import Today
 
+from libplaceaddress import (PLACE_KEYS, PlaceAddress, LazyValues,
+                             FormatStringParser, get_place_resolver, get_place_title)
+
 __version__ = "0.3.4"
 
 try:
@@ -70,6 +99,591 @@ except ValueError:
     _trans = glocale.translation
 _ = _trans.gettext
 
+LOG = logging.getLogger(".GedcomOptions")
+
+# maximum number of place objects kept in memory while walking place trees
+_PLACE_CACHE_SIZE = 2000
+
+# maximum number of places whose coordinates are kept in GEDCOM format
+_COORDINATE_CACHE_SIZE = 5000
+
+# number of sort keys held in memory before a sorted run is spilled to disk
+_SORT_CHUNK_SIZE = 100000
+
+# number of streamed records whose events and places are read ahead at a time
+_READ_AHEAD_SIZE = 100
+
+# address fields rendered from templates: GEDCOM tag, label and default template
+ADDRESS_FORMATS = [('ADR1', _("Address 1"),
+                    "%street, %unknown, %custom, %department, %building, %farm, %neighborhood"),
+                   ('ADR2', _("Address 2"), "%hamlet, %village, %borough, %locality"),
+                   ('CITY', _("City"), "%municipality, %town, %city, %parish"),
+                   ('STAE', _("State"), "%district, %province, %region, %county, %state")]
+
+# sort value bounds used for open ended date intervals
+_MIN_SORT_VALUE = -sys.maxsize
+_MAX_SORT_VALUE = sys.maxsize
+
+# number of places listed by GRAMPS ID in the invalid coordinates summary
+_MAX_REPORTED_PLACES = 50
+
+# maximum number of shard files of a sharded export
+_MAX_SHARD_COUNT = 99
+
+# line with a cross-reference pointer as its value, e.g. "1 FAMS @F0001@"
+_POINTER_LINE = re.compile(r"^[1-9][0-9]* ([^ \n]+) @([^@ \n]+)@$", re.MULTILINE)
+
+# tags of the records that pointers of a tag refer to
+_POINTER_RECORDS = {'FAMS': 'FAM', 'FAMC': 'FAM', 'HUSB': 'INDI', 'WIFE': 'INDI',
+                    'CHIL': 'INDI', 'ASSO': 'INDI', 'ALIA': 'INDI', 'SOUR': 'SOUR',
+                    'REPO': 'REPO', 'NOTE': 'NOTE', 'OBJE': 'OBJE'}
+
+# type of text values that can be written without conversion
+_TEXT_TYPE = type("")
+
+# minimum number of seconds between updates of the progress text
+_PROGRESS_TEXT_INTERVAL = 1.0
+
+# the GEDCOM writer updates progress once per this many notes
+_NOTES_PER_UPDATE = getattr(exportgedcom, 'NOTES_PER_PERSON', 104)
+
+
+class ExportCancelled(Exception):
+    """
+    Raised between records when the user has cancelled the export
+    """
+    pass
+
+
+# number of allocation sites listed per snapshot in the memory report
+_MEMORY_REPORT_TOP = 25
+
+
+class MemoryProfile(object):
+    """
+    Takes tracemalloc snapshots at the phase boundaries of an export and
+    collects a report of the top allocation sites and of the growth since
+    the previous snapshot. Only the previous snapshot is kept in memory.
+    """
+
+    def __init__(self, top=_MEMORY_REPORT_TOP):
+        self.top = top
+        self.lines = []
+        self._previous = None
+        self._started = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    def stop(self):
+        self._previous = None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def snapshot(self, label, cache_sizes):
+        """
+        Take a snapshot and add it to the report with the given cache sizes
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        lines = self.lines
+        lines.append("== %s" % label)
+        lines.append("traced memory: %.1f MiB, peak %.1f MiB"
+                     % (current / 1048576.0, peak / 1048576.0))
+        for name, size in cache_sizes:
+            lines.append("  %-30s %d" % (name, size))
+        lines.append("top allocation sites:")
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            lines.append("  %s" % stat)
+        if self._previous is not None:
+            lines.append("growth since previous snapshot:")
+            for stat in snapshot.compare_to(self._previous, 'lineno')[:self.top]:
+                lines.append("  %s" % stat)
+        lines.append("")
+        self._previous = snapshot
+
+    def write_report(self, filename):
+        with io.open(filename, "w", encoding="utf-8") as report:
+            for line in self.lines:
+                report.write("%s\n" % line)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class LRUCache(object):
+    """
+    Mapping that keeps at most maxsize of the most recently used entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+
+def iter_sorted_keys(keys, chunk_size=_SORT_CHUNK_SIZE):
+    """
+    Generates (gramps_id, handle) pairs in sorted order.
+
+    Keys are sorted in chunks of chunk_size. If there are more keys than fit
+    in one chunk, sorted runs are spilled into temporary files and merged,
+    so that the memory use does not depend on the number of keys.
+    """
+    runs = []
+    chunk = []
+    try:
+        for key in keys:
+            chunk.append(key)
+            if len(chunk) >= chunk_size:
+                runs.append(_spill_sorted_run(chunk))
+                chunk = []
+        chunk.sort()
+        if not runs:
+            for key in chunk:
+                yield key
+            return
+        if chunk:
+            runs.append(_spill_sorted_run(chunk))
+            chunk = []
+        for key in heapq.merge(*[_read_sorted_run(run) for run in runs]):
+            yield key
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _spill_sorted_run(chunk):
+    chunk.sort()
+    run = tempfile.TemporaryFile()
+    for gramps_id, handle in chunk:
+        run.write(("%s\t%s\n" % (gramps_id, handle)).encode("utf-8"))
+    run.seek(0)
+    return run
+
+
+def _read_sorted_run(run):
+    for line in run:
+        gramps_id, handle = line.decode("utf-8").rstrip("\n").split("\t")
+        yield gramps_id, handle
+
+
+def _sort_value(calendar, year, month, day):
+    date = Date()
+    date.set(calendar=calendar, value=(day, month, year, False))
+    return date.get_sort_value()
+
+
+def _last_sort_value(calendar, year, month, day):
+    """
+    Returns the sort value of the last day covered by a (partial) date
+    """
+    if month == 0:
+        return _sort_value(calendar, year + 1, 1, 1) - 1
+    if day == 0:
+        if month == 12:
+            return _sort_value(calendar, year + 1, 1, 1) - 1
+        return _sort_value(calendar, year, month + 1, 1) - 1
+    return _sort_value(calendar, year, month, day)
+
+
+def date_interval(date):
+    """
+    Returns the range of sort values (julian day numbers) a date covers as a
+    (start, stop) tuple. Before, after and about dates are widened by the same
+    ranges that Date.match uses. An empty date covers the whole time line, and
+    a date that has no sort value (text only) returns None.
+    """
+    if date.is_empty():
+        return _MIN_SORT_VALUE, _MAX_SORT_VALUE
+    start = date.get_sort_value()
+    if not start:
+        return None
+    calendar = date.get_calendar()
+    if date.is_compound():
+        stop = _last_sort_value(calendar, date.get_stop_year(),
+                                date.get_stop_month(), date.get_stop_day())
+    else:
+        stop = _last_sort_value(calendar, date.get_year(),
+                                date.get_month(), date.get_day())
+
+    modifier = date.get_modifier()
+    if modifier == Date.MOD_BEFORE:
+        start -= int(config.get('behavior.date-before-range') * 365.25)
+    elif modifier == Date.MOD_AFTER:
+        stop += int(config.get('behavior.date-after-range') * 365.25)
+    elif modifier == Date.MOD_ABOUT:
+        about = int(config.get('behavior.date-about-range') * 365.25)
+        start -= about
+        stop += about
+    return start, stop
+
+
+def _zoom_level(latitude_spread, longitude_spread, latitude):
+    """
+    Returns a map zoom level at which coordinates spread over the given
+    ranges (in degrees) fit on the map, or None if there is no spread
+    """
+    spread = max(latitude_spread,
+                 longitude_spread * math.cos(math.radians(latitude)))
+    if spread <= 0:
+        return None
+    return max(1, min(13, int(math.log(360.0 / spread, 2))))
+
+
+class PlaceRefIndex(object):
+    """
+    Interval index of dated place references.
+
+    For each place, the enclosing places are stored with the ranges of days
+    their place references are valid, sorted by the start of the range. The
+    enclosing place for a date is then found by a bisect lookup instead of
+    matching every place reference date.
+    """
+
+    def __init__(self):
+        self._refs = {}
+
+    def add_place(self, place):
+        """
+        Add place references of the place into the index
+        """
+        entries = []
+        for order, placeref in enumerate(place.get_placeref_list()):
+            interval = date_interval(placeref.get_date_object())
+            if interval is not None:
+                entries.append((interval[0], interval[1], order, placeref.ref))
+        if entries:
+            entries.sort()
+            starts = tuple(entry[0] for entry in entries)
+            self._refs[place.handle] = (starts, tuple(entries))
+
+    def get_parent(self, handle, interval):
+        """
+        Returns the handle of the place enclosing the given place during the
+        date interval, or None. As with Date.match, the last matching place
+        reference wins.
+        """
+        refs = self._refs.get(handle)
+        if refs is None:
+            return None
+        starts, entries = refs
+        if interval is None:
+            # date without sort value matches only references without date
+            candidates = [entry for entry in entries
+                          if entry[0] == _MIN_SORT_VALUE and entry[1] == _MAX_SORT_VALUE]
+        else:
+            # references starting after the end of the interval cannot match
+            candidates = [entry for entry in entries[:bisect_right(starts, interval[1])]
+                          if entry[1] >= interval[0]]
+        parent = None
+        last_order = -1
+        for start, stop, order, ref in candidates:
+            if order > last_order:
+                parent = ref
+                last_order = order
+        return parent
+
+    def __len__(self):
+        return len(self._refs)
+
+
+class RecordBuffer(object):
+    """
+    Collects the lines of a record, while it is used in place of the GEDCOM file
+    """
+    __slots__ = ('lines', 'write')
+
+    def __init__(self):
+        self.lines = []
+        self.write = self.lines.append
+
+    def getvalue(self):
+        return "".join(self.lines)
+
+
+class ReadAheadDatabase(object):
+    """
+    Used in place of the database while streamed records are written.
+
+    The events of a batch of records and the places of the events are read
+    ahead in handle order, which is also the order of the database tables,
+    and the writer gets them back from memory. Events are kept for one batch,
+    places in the bounded place cache of the export. Other reads go to the
+    database.
+    """
+
+    def __init__(self, db, place_cache):
+        self._db = db
+        self._place_cache = place_cache
+        self._events = {}
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def read_ahead(self, objs):
+        """
+        Reads the events of the people or families and the places of the
+        events, replacing the events of the previous batch
+        """
+        event_handles = set()
+        for obj in objs:
+            event_handles.update(event_ref.ref for event_ref in obj.get_event_ref_list())
+        events = {}
+        place_handles = set()
+        for handle in sorted(event_handles):
+            event = self._db.get_event_from_handle(handle)
+            if event is not None:
+                events[handle] = event
+                place_handles.add(event.get_place_handle())
+        self._events = events
+        place_handles.discard(None)
+        place_handles.discard("")
+        for handle in sorted(place_handles):
+            self.get_place_from_handle(handle)
+
+    def get_event_from_handle(self, handle):
+        event = self._events.get(handle)
+        if event is None:
+            event = self._db.get_event_from_handle(handle)
+        return event
+
+    def get_place_from_handle(self, handle):
+        place = self._place_cache.get(handle)
+        if place is None:
+            place = self._db.get_place_from_handle(handle)
+            if place is not None:
+                self._place_cache[handle] = place
+        return place
+
+
+class GedcomShards(object):
+    """
+    Used in place of the GEDCOM file to split the records into shard files.
+
+    Every shard is a GEDCOM file of its own, with the same HEAD and SUBM
+    records. Records of each tag are split into ranges of GRAMPS IDs:
+    boundaries maps a tag to the first ID of each shard after the first
+    one, and records of tags without boundaries go to the first shard.
+    Only the boundaries are kept, so the shard of any record, including
+    records referenced from other shards, is found from its ID.
+
+    When the file is closed, a JSON manifest is written with the number of
+    records of each shard, the boundaries, and the references of each shard
+    to records in other shards with the file that defines them. The
+    references are kept in temporary files and sorted there, so that memory
+    use doesn't depend on their number.
+
+    The first shard is the GEDCOM file opened by the exporter, other shards
+    are named after it with the number of the shard, e.g. tree-2.ged.
+    """
+
+    def __init__(self, gedcom_file, filename, count, boundaries):
+        stem, ext = os.path.splitext(filename)
+        self.filenames = [filename] + ["%s-%d%s" % (stem, number, ext)
+                                       for number in range(2, count + 1)]
+        self.manifest_name = stem + "-manifest.json"
+        self.boundaries = boundaries
+        encoding = getattr(gedcom_file, 'encoding', None) or "utf-8"
+        self._files = [gedcom_file]
+        # references to the other shards as "xref TAB shard index" lines
+        self._references = [tempfile.TemporaryFile() for name in self.filenames]
+        try:
+            for name in self.filenames[1:]:
+                self._files.append(io.open(name, "w", encoding=encoding))
+        except IOError:
+            self.discard()
+            raise
+        # HEAD and SUBM, written into every shard before the first record
+        self._header = []
+        self._header_written = False
+        self._record = []
+        # shard of the current record, None for shared and skipped records
+        self._shard = None
+        self._shared = False
+        # numbers of records by tag
+        self._counts = [{} for name in self.filenames]
+
+    def get_shard(self, tag, gramps_id):
+        """
+        Returns the index of the shard of the record with the tag and ID
+        """
+        return bisect_right(self.boundaries.get(tag, ()), gramps_id)
+
+    def write(self, text):
+        if text.startswith("0 "):
+            self._end_record()
+            self._begin_record(text)
+        self._record.append(text)
+
+    def _begin_record(self, text):
+        fields = text.split("\n", 1)[0].split(" ", 3)
+        if len(fields) > 2 and fields[1].startswith("@"):
+            gramps_id, tag = fields[1].strip("@"), fields[2]
+        else:
+            gramps_id, tag = "", fields[1]
+        self._shared = tag in ("HEAD", "SUBM")
+        if self._shared or tag == "TRLR":
+            # trailers are written when the shards are closed
+            self._shard = None
+            return
+        self._shard = self.get_shard(tag, gramps_id)
+        counts = self._counts[self._shard]
+        counts[tag] = counts.get(tag, 0) + 1
+
+    def _end_record(self):
+        if not self._record:
+            return
+        text = "".join(self._record)
+        self._record = []
+        if self._shared:
+            self._header.append(text)
+        elif self._shard is not None:
+            self._write_header()
+            self._files[self._shard].write(text)
+            references = self._references[self._shard]
+            for pointer_tag, gramps_id in _POINTER_LINE.findall(text):
+                tag = _POINTER_RECORDS.get(pointer_tag)
+                if tag is None:
+                    continue
+                shard = self.get_shard(tag, gramps_id)
+                if shard != self._shard:
+                    references.write(("@%s@\t%d\n" % (gramps_id, shard)).encode("utf-8"))
+
+    def _write_header(self):
+        if not self._header_written:
+            header = "".join(self._header)
+            for gedcom_file in self._files:
+                gedcom_file.write(header)
+            self._header_written = True
+
+    def close(self):
+        """
+        Finish the shards and write the manifest
+        """
+        self._end_record()
+        self._write_header()
+        for gedcom_file in self._files:
+            gedcom_file.write("0 TRLR\n")
+            gedcom_file.close()
+        self.check_spread()
+        try:
+            with io.open(self.manifest_name, "w", encoding="utf-8") as manifest:
+                self.write_manifest(manifest)
+        finally:
+            self._close_references()
+
+    def discard(self):
+        """
+        Close the shards and remove all but the first one
+        """
+        for gedcom_file in self._files:
+            gedcom_file.close()
+        self._close_references()
+        for name in self.filenames[1:len(self._files)]:
+            try:
+                os.remove(name)
+            except OSError as msg:
+                LOG.warning("Could not remove %s: %s", name, msg)
+
+    def check_spread(self):
+        """
+        Logs a warning for each record tag that has at least as many records
+        as there are shards, but is missing from some of the shards. Returns
+        the tags.
+        """
+        totals = {}
+        for counts in self._counts:
+            for tag, count in counts.items():
+                totals[tag] = totals.get(tag, 0) + count
+        unspread = []
+        for tag, total in sorted(totals.items()):
+            if total < len(self._files):
+                continue
+            missing = [os.path.basename(name)
+                       for name, counts in zip(self.filenames, self._counts)
+                       if not counts.get(tag)]
+            if missing:
+                LOG.warning("%d %s records were not split into all shards, "
+                            "none in %s", total, tag, ", ".join(missing))
+                unspread.append(tag)
+        return unspread
+
+    def _close_references(self):
+        for references in self._references:
+            references.close()
+
+    def iter_references(self, index):
+        """
+        Generates (xref, shard index) of the records in other shards that
+        are referenced from the shard, sorted by xref
+        """
+        references = self._references[index]
+        references.seek(0)
+        previous = None
+        for xref, shard in iter_sorted_keys(_read_sorted_run(references)):
+            if xref != previous:
+                previous = xref
+                yield xref, int(shard)
+
+    def write_manifest(self, manifest):
+        """
+        Writes the manifest: file name, number of records by tag and the
+        referenced xrefs in other shards with the files defining them of
+        each shard, and the first GRAMPS ID of each shard after the first
+        one by record tag. Shards are written one at a time, and references
+        one by one.
+        """
+        names = [os.path.basename(name) for name in self.filenames]
+        boundaries = dict((tag, dict(zip(names[1:], ids)))
+                          for tag, ids in self.boundaries.items())
+        manifest.write('{\n "boundaries": %s,\n' % json.dumps(boundaries, sort_keys=True))
+        manifest.write(' "lookup": %s,\n' % json.dumps(
+            "A record is in the last file whose boundary for the tag of the "
+            "record is not greater than the GRAMPS ID of the record, compared "
+            "as strings, or in the first file"))
+        manifest.write(' "shards": [')
+        for index, name in enumerate(names):
+            manifest.write('%s\n  {"file": %s, "records": %s, "references": {'
+                           % ("," if index else "", json.dumps(name),
+                              json.dumps(self._counts[index], sort_keys=True)))
+            separator = "\n   "
+            for xref, shard in self.iter_references(index):
+                manifest.write('%s%s: %s' % (separator, json.dumps(xref), json.dumps(names[shard])))
+                separator = ",\n   "
+            manifest.write("}}")
+        manifest.write("\n ]\n}\n")
+
+
 class GedcomWriterExtension(exportgedcom.GedcomWriter):
     """
     GedcomWriter extension
@@ -87,7 +701,21 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
     _unknown_level_place_types = [PlaceType.UNKNOWN, PlaceType.CUSTOM] # will be interpreted with highest accuracy
 
     def __init__(self, database, user, option_box=None):
+        # progress of the current phase, see reset() and _update_record()
+        self._phase_text = ""
+        self._phase_total = None
+        self._phase_count = 0
+        self._phase_start = time.time()
+        self._progress_time = 0
+        self._progress_meter = None
+        self._meter_percent = 0
+        self._cancelled = False
+
         super(GedcomWriterExtension, self).__init__(database, user, option_box)
+        self.user = user
+        # check for cancelling and update the progress text between records
+        self._update_progress = self.update
+        self.update = self._update_record
         if option_box:
 
             self.get_coordinates = option_box.get_coordinates
@@ -97,6 +725,12 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
             self.include_tng_place_levels = option_box.include_tng_place_levels
             self.omit_borough_from_address = option_box.omit_borough_from_address
             self.move_patronymics = option_box.move_patronymics
+            self.stream_records = option_box.stream_records
+            self.aggregate_coordinates = option_box.aggregate_coordinates
+            self.address_formats = option_box.address_formats
+            self.show_progress_window = option_box.show_progress_window
+            self.memory_profile = option_box.memory_profile
+            self.shard_count = option_box.shard_count
         else:
             self.get_coordinates = 1
             self.export_only_useful_pe_addresses = 1
@@ -105,7 +739,374 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
             self.include_tng_place_levels = 1
             self.omit_borough_from_address = 1
             self.move_patronymics = 1
+            self.stream_records = 1
+            self.aggregate_coordinates = 1
+            self.address_formats = dict((tag, fmt) for tag, label, fmt in ADDRESS_FORMATS)
+            self.show_progress_window = 0
+            self.memory_profile = 0
+            self.shard_count = 1
+
+        # address templates are compiled once per export
+        parser = FormatStringParser(list(PLACE_KEYS))
+        self._address_templates = dict((tag, parser.compile(fmt))
+                                       for tag, fmt in self.address_formats.items())
+
+        self._place_cache = LRUCache(_PLACE_CACHE_SIZE)
+        # titles and addresses of places whose place tree doesn't depend on the date
+        self._resolver = get_place_resolver(self.dbase)
+        # place handle -> coordinates in GEDCOM format
+        self._coordinates = LRUCache(_COORDINATE_CACHE_SIZE)
+        # number of places with invalid coordinates, and the smallest of their GRAMPS IDs
+        self._invalid_count = 0
+        self._invalid_coordinates = []
+        self._placeref_index = None
+        self._aggregated_coordinates = None
+        self._place_date = None
+        self._today_interval = date_interval(Today())
+        # (level, tag) -> line prefix and line without value
+        self._line_prefixes = {}
+        self._shards = None
+        self._memory_profile = None
+        if self.memory_profile and tracemalloc is not None:
+            self._memory_profile = MemoryProfile()
+
+    def write_gedcom_file(self, filename):
+        """
+        Write the actual GEDCOM file and report places with invalid coordinates.
+        Returns False if the export was cancelled.
+        """
+        if self.show_progress_window:
+            # imported here, as the exporter can be used without GUI
+            from gramps.gui.utils import ProgressMeter
+            self._progress_meter = ProgressMeter(_("GEDCOM Export"), can_cancel=True,
+                                                 cancel_callback=self.cancel)
+        if self._memory_profile:
+            self._memory_profile.start()
+            self._memory_snapshot(_("Start of export"))
+        try:
+            if self._placeref_index is None:
+                self._phase_total = self.dbase.get_number_of_places()
+                self.reset(_("Reading places"))
+                self._index_places()
+            ret = super(GedcomWriterExtension, self).write_gedcom_file(filename)
+        except ExportCancelled:
+            self._close_cancelled_file(filename)
+            return False
+        finally:
+            # the resolver is shared, e.g. with the AddressPreview gramplet
+            self._resolver.trim()
+            if self._progress_meter:
+                self._progress_meter.close()
+                self._progress_meter = None
+            if self._memory_profile:
+                self._write_memory_report(filename)
+        self._report_invalid_coordinates()
+        return ret
 
+    def _memory_snapshot(self, label):
+        if self._memory_profile:
+            self._memory_profile.snapshot(label, self._export_cache_sizes())
+
+    def _export_cache_sizes(self):
+        """
+        Returns (name, number of entries) of the caches used by the export
+        """
+        sizes = [("place cache", len(self._place_cache)),
+                 ("line prefixes", len(self._line_prefixes))]
+        for name, size in sorted(self._resolver.cache_sizes().items()):
+            sizes.append(("place resolver " + name, size))
+        sizes.append(("coordinates", len(self._coordinates)))
+        sizes.append(("invalid coordinates", len(self._invalid_coordinates)))
+        if self._placeref_index is not None:
+            sizes.append(("place reference index", len(self._placeref_index)))
+        if self._aggregated_coordinates is not None:
+            sizes.append(("aggregated coordinates", len(self._aggregated_coordinates)))
+        return sizes
+
+    def _write_memory_report(self, filename):
+        """
+        Writes the memory report next to the GEDCOM file
+        """
+        self._memory_snapshot(_("End of export"))
+        self._memory_profile.stop()
+        report_name = os.path.splitext(filename)[0] + "-memory.txt"
+        try:
+            self._memory_profile.write_report(report_name)
+        except IOError as msg:
+            LOG.warning("Could not write memory report %s: %s", report_name, msg)
+        else:
+            LOG.info("Memory report written to %s", report_name)
+
+    def cancel(self, *args):
+        """
+        Cancel the export. Writing stops before the next record.
+        """
+        self._cancelled = True
+
+    def _close_cancelled_file(self, filename):
+        """
+        Close and remove the partially written GEDCOM file. Nothing is
+        removed if the export was cancelled before the file was opened.
+        """
+        LOG.warning("GEDCOM export cancelled: %s, %d/%d records written",
+                    self._phase_text, self._phase_count, self.total)
+        if self._shards is not None:
+            self._shards.discard()
+        elif self.gedcom_file is not None:
+            self.gedcom_file.close()
+        else:
+            return
+        try:
+            os.remove(filename)
+        except OSError as msg:
+            LOG.warning("Could not remove %s: %s", filename, msg)
+
+    def reset(self, text=""):
+        """
+        Start a new phase of the export. If the number of records in the
+        phase is known, it is used as the total of the progress.
+        """
+        if self._phase_text:
+            self._memory_snapshot(_("After %s") % self._phase_text)
+        super(GedcomWriterExtension, self).reset(text)
+        self._phase_text = text
+        self._phase_count = 0
+        self._phase_start = time.time()
+        self._progress_time = 0
+        if self._phase_total is not None:
+            self.set_total(self._phase_total)
+            self._phase_total = None
+        if self._progress_meter:
+            self._progress_meter.set_pass(text, 100)
+            self._meter_percent = 0
+
+    def _update_record(self, count=None):
+        """
+        Called before each record is written, in place of UpdateCallback.update.
+        Raises ExportCancelled if the export has been cancelled, and adds the
+        number of records done and the estimated time left to the progress text.
+        """
+        if self._cancelled:
+            raise ExportCancelled()
+        self._phase_count += 1
+        now = time.time()
+        if now - self._progress_time >= _PROGRESS_TEXT_INTERVAL:
+            self._progress_time = now
+            self.text = self._progress_text(now)
+        self._update_progress(count)
+        if self._progress_meter:
+            percent = min(100, 100 * self._phase_count // self.total)
+            while self._meter_percent < percent:
+                self._progress_meter.step()
+                self._meter_percent += 1
+
+    def _progress_text(self, now):
+        """
+        Returns the progress text of the current phase with an estimate of
+        the time left, based on the throughput of the phase so far
+        """
+        done = self._phase_count
+        total = max(self.total, done)
+        elapsed = now - self._phase_start
+        if done < 2 or elapsed <= 0:
+            return _("%(phase)s: %(done)d/%(total)d") % {
+                'phase': self._phase_text, 'done': done, 'total': total}
+        left = (total - done) * elapsed / done
+        return _("%(phase)s: %(done)d/%(total)d, %(left)s left") % {
+            'phase': self._phase_text, 'done': done, 'total': total,
+            'left': _format_duration(left)}
+
+    def _header(self, filename):
+        """
+        Starts splitting the records into shard files, if more than one file
+        is wanted, before the header is written
+        """
+        if self.shard_count > 1:
+            boundaries = {
+                'INDI': self._shard_boundaries(self.dbase.get_person_cursor),
+                'FAM': self._shard_boundaries(self.dbase.get_family_cursor),
+                'SOUR': self._shard_boundaries(self.dbase.get_source_cursor),
+                'REPO': self._shard_boundaries(self.dbase.get_repository_cursor),
+                'NOTE': self._shard_boundaries(self.dbase.get_note_cursor)}
+            self._shards = GedcomShards(self.gedcom_file, filename,
+                                        self.shard_count, boundaries)
+            self.gedcom_file = self._shards
+        super(GedcomWriterExtension, self)._header(filename)
+
+    def _shard_boundaries(self, get_cursor):
+        """
+        Returns the first GRAMPS ID of each shard after the first one, so
+        that the records of a table are split into shards of equal size.
+        """
+        counter = [0]
+
+        def count_keys(keys):
+            for key in keys:
+                counter[0] += 1
+                yield key
+
+        # all the keys are read and counted before the first sorted key
+        boundaries = []
+        for index, (gramps_id, handle) in \
+                enumerate(iter_sorted_keys(count_keys(self._iter_sort_keys(get_cursor)))):
+            if index * self.shard_count // counter[0] > len(boundaries):
+                boundaries.append(gramps_id)
+        return boundaries
+
+    def _writeln(self, level, token, textlines="", limit=72):
+        """
+        Writes a line like GedcomWriter._writeln does
+
+        Values that don't need to be split into CONC and CONT lines or
+        escaped are written with a cached prefix of level and tag; other
+        values are left for GedcomWriter._writeln, so the output is the same.
+        """
+        if textlines:
+            if type(textlines) is not _TEXT_TYPE \
+                    or limit and len(textlines) > limit \
+                    or '\n' in textlines or '\r' in textlines \
+                    or '@' in textlines and textlines[0] != '@':
+                super(GedcomWriterExtension, self)._writeln(level, token, textlines, limit)
+                return
+            self.gedcom_file.write(self._line_prefix(level, token)[0] + textlines + "\n")
+        else:
+            self.gedcom_file.write(self._line_prefix(level, token)[1])
+
+    def _line_prefix(self, level, token):
+        """
+        Returns the line prefix of level and tag and the line without value.
+        Level 0 lines have cross-reference ids as tags, so they are not cached.
+        """
+        prefixes = self._line_prefixes.get((level, token))
+        if prefixes is None:
+            prefixes = ("%d %s " % (level, token), "%d %s\n" % (level, token))
+            if level:
+                self._line_prefixes[(level, token)] = prefixes
+        return prefixes
+
+    def _write_record(self, write_method, obj):
+        """
+        Writes a record with a single write to the GEDCOM file, by collecting
+        its lines into a RecordBuffer
+        """
+        gedcom_file = self.gedcom_file
+        record = RecordBuffer()
+        self.gedcom_file = record
+        try:
+            write_method(obj)
+        finally:
+            self.gedcom_file = gedcom_file
+        gedcom_file.write(record.getvalue())
+
+    def _person(self, person):
+        self._write_record(super(GedcomWriterExtension, self)._person, person)
+
+    def _family(self, family):
+        self._write_record(super(GedcomWriterExtension, self)._family, family)
+
+    def _individuals(self):
+        """
+        Write the individual people to the gedcom file, sorted by GRAMPS ID.
+
+        In streaming mode people are read in sorted order in small batches,
+        with their events and places read ahead (see _write_streamed),
+        instead of collecting handles and person objects in memory first.
+        Place data is still held for all places, see _index_places().
+        """
+        self._phase_total = self.dbase.get_number_of_people()
+        if not self.stream_records:
+            super(GedcomWriterExtension, self)._individuals()
+            return
+
+        self.reset(_("Writing individuals"))
+        self._write_streamed(self.dbase.get_person_cursor,
+                             self.dbase.get_person_from_handle, self._person)
+
+    def _families(self):
+        """
+        Write out the list of families, sorted by GRAMPS ID.
+        """
+        self._phase_total = self.dbase.get_number_of_families()
+        if not self.stream_records:
+            super(GedcomWriterExtension, self)._families()
+            return
+
+        self.reset(_("Writing families"))
+        self._write_streamed(self.dbase.get_family_cursor,
+                             self.dbase.get_family_from_handle, self._family)
+
+    def _sources(self):
+        self._phase_total = self.dbase.get_number_of_sources()
+        super(GedcomWriterExtension, self)._sources()
+
+    def _repos(self):
+        self._phase_total = self.dbase.get_number_of_repositories()
+        super(GedcomWriterExtension, self)._repos()
+
+    def _notes(self):
+        self._phase_total = int(math.ceil(self.dbase.get_number_of_notes()
+                                          / float(_NOTES_PER_UPDATE)))
+        super(GedcomWriterExtension, self)._notes()
+
+    def _write_streamed(self, get_cursor, get_object, write_object):
+        """
+        Writes the objects of a table in GRAMPS ID order with write_object.
+
+        Objects are read in batches of _READ_AHEAD_SIZE, and the events and
+        places of each batch are read ahead before the batch is written.
+        The writer reads them through a ReadAheadDatabase, which is used in
+        place of the database while the objects are written.
+        """
+        database = self.dbase
+        read_ahead = ReadAheadDatabase(database, self._place_cache)
+        self.dbase = read_ahead
+        try:
+            batch = []
+            for obj in self._iter_sorted(get_cursor, get_object):
+                batch.append(obj)
+                if len(batch) >= _READ_AHEAD_SIZE:
+                    self._write_batch(read_ahead, batch, write_object)
+                    batch = []
+            self._write_batch(read_ahead, batch, write_object)
+        finally:
+            self.dbase = database
+
+    def _write_batch(self, read_ahead, batch, write_object):
+        read_ahead.read_ahead(batch)
+        for obj in batch:
+            self.update()
+            write_object(obj)
+
+    def _iter_sorted(self, get_cursor, get_object):
+        """
+        Generates objects of a table in GRAMPS ID order.
+
+        Only (gramps_id, handle) pairs are read from the table cursor for
+        sorting, objects are fetched one by one when they are needed.
+        """
+        handles = (handle for gramps_id, handle
+                   in iter_sorted_keys(self._iter_sort_keys(get_cursor)))
+        for handle in handles:
+            obj = get_object(handle)
+            if obj:
+                yield obj
+
+    def _iter_sort_keys(self, get_cursor):
+        with get_cursor() as cursor:
+            for key, data in cursor:
+                # serialized data starts with handle and gramps id
+                yield data[1], data[0]
+
+    def _dump_event_stats(self, event, event_ref):
+        """
+        Write the event details, resolving the event's place hierarchy by
+        the date of the event
+        """
+        self._place_date = event.get_date_object()
+        try:
+            super(GedcomWriterExtension, self)._dump_event_stats(event, event_ref)
+        finally:
+            self._place_date = None
 
     def _person_name(self, name, attr_nick):
         """
@@ -203,7 +1204,8 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
             +1 POST <POSTAL CODE>
             +1 CTRY <COUNTRY>
 
-        Where
+        Where ADDR1, ADDR2, CITY and STATE are rendered from address templates (see ADDRESS_FORMATS),
+        by default
             ADDR1 = street, unknown, custom, department, building, farm, neighborhood
             ADDR2 = hamlet, village, borough, locality
             CITY = municipality, town, city, parish
@@ -214,7 +1216,12 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
         if place is None:
             return
 
-        place_name = place_displayer.display(self.dbase, place)
+        # historical place hierarchy is resolved by the date of the event
+        date = self._place_date
+        if self._resolver.is_dated(place):
+            place_name = self._place_title(list(self.iter_place_entries(place, date)))
+        else:
+            place_name = self._resolver.get_title(place)
         self._writeln(level, "PLAC", place_name.replace('\r', ' '), limit=120)
         longitude = place.get_longitude()
         latitude = place.get_latitude()
@@ -223,49 +1230,57 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
         # Get missing coordinates from place tree
 
         max_place_level_difference = 2
+        inherited_handle = None
+        inherited_type = None
 
         place_level = self._tng_place_level(place)[0]
         zoom_level = self._tng_place_level(place)[1]
 
-        if self.get_coordinates:
+        # Get missing coordinates from places within the place
+        aggregated = None
+        if self.aggregate_coordinates and not longitude and not latitude:
+            aggregated = self._get_aggregated_coordinates(place)
+            if aggregated:
+                zoom_level = aggregated[2]
+
+        if self.get_coordinates and not aggregated:
 
             test_tng_place_level = place_level
-            inherited_place = None
 
             place_level_diff = 999
 
             if self.get_coordinates and not longitude and not latitude:
-                place_list = self.get_place_list(place)
-                if len(place_list) > 1:
-                    for place_above in place_list:
-                        if place is not place_above:
-                            title_above = place_displayer.display(self.dbase, place_above).replace('\r', ' ')
-
-                            test_longitude = place_above.get_longitude()
-                            test_latitude = place_above.get_latitude()
-                            if test_latitude and test_longitude:
-                                test_tng_place_level = self._tng_place_level(place_above)[0]
-                                test_place_level_diff = test_tng_place_level - place_level
-
-                                # negative differences means the place is even more accurate
-                                # (how to treat this?)
-                                if test_place_level_diff < 0:
-                                    test_place_level_diff = 0
-
-                                if test_place_level_diff < place_level_diff \
-                                        and test_place_level_diff <=  max_place_level_difference \
-                                        or title == title_above:
-                                    longitude = test_longitude
-                                    latitude = test_latitude
-                                    inherited_place = place_above
-                                    place_level_diff = test_place_level_diff
-                    if inherited_place:
-                        place_level = self._tng_place_level(inherited_place)[0]
-                        zoom_level = self._tng_place_level(inherited_place)[1]
-
-
-        if longitude and latitude:
-            (latitude, longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
+                entries = list(self.iter_place_entries(place, date))
+                for index, (handle_above, name_above, type_above, test_latitude, test_longitude) \
+                        in enumerate(entries):
+                    if handle_above != place.handle:
+                        if test_latitude and test_longitude:
+                            test_tng_place_level = self._tng_type_level(type_above)[0]
+                            test_place_level_diff = test_tng_place_level - place_level
+
+                            # negative differences means the place is even more accurate
+                            # (how to treat this?)
+                            if test_place_level_diff < 0:
+                                test_place_level_diff = 0
+
+                            # the title is read only when the levels don't decide
+                            if test_place_level_diff < place_level_diff \
+                                    and test_place_level_diff <=  max_place_level_difference \
+                                    or title == self._place_title(entries[index:]):
+                                longitude = test_longitude
+                                latitude = test_latitude
+                                inherited_handle = handle_above
+                                inherited_type = type_above
+                                place_level_diff = test_place_level_diff
+                if inherited_handle:
+                    place_level = self._tng_type_level(inherited_type)[0]
+                    zoom_level = self._tng_type_level(inherited_type)[1]
+
+
+        if aggregated:
+            (latitude, longitude) = aggregated[:2]
+        elif longitude and latitude:
+            (latitude, longitude) = self._get_gedcom_coordinates(inherited_handle or place.handle)
         if longitude and latitude:
             self._writeln(level+1, "MAP")
             self._writeln(level+2, 'LATI', latitude)
@@ -280,38 +1295,16 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
 
 
         title = place_name.replace('\r', ' ')
-        location = get_main_location(self.dbase, place)
-        postal_code = place.get_code()
-
-        neighborhood = location.get(PlaceType.NEIGHBORHOOD)
-        custom = location.get(PlaceType.CUSTOM)
-        department = location.get(PlaceType.DEPARTMENT)
-        street = location.get(PlaceType.STREET)
-        farm = location.get(PlaceType.FARM)
-        unknown = location.get(PlaceType.UNKNOWN)
-        building = location.get(PlaceType.BUILDING)
-        hamlet = location.get(PlaceType.HAMLET)
-        locality = location.get(PlaceType.LOCALITY)
-        village = location.get(PlaceType.VILLAGE)
-        borough = location.get(PlaceType.BOROUGH)
-        city = location.get(PlaceType.CITY)
-        town = location.get(PlaceType.TOWN)
-        municipality = location.get(PlaceType.MUNICIPALITY)
-        parish = location.get(PlaceType.PARISH)
-        country = location.get(PlaceType.COUNTRY)
-        county = location.get(PlaceType.COUNTY)
-        region = location.get(PlaceType.REGION)
-        state = location.get(PlaceType.STATE)
-        district = location.get(PlaceType.DISTRICT)
-        province = location.get(PlaceType.PROVINCE)
+        address = self.get_place_address(place, date)
+        postal_code = address.code
+        country = address.country
+        city = address.city
+        state = address.state
 
         # Check if there is any piece of information in places that is not in place's title, and if is,
         # will add address data in gedcom
         if self.export_only_useful_pe_addresses:
-            should_show_address = self._is_extra_info_in_place_names(
-                title,
-                [street, farm, building, department, hamlet, unknown, village, town, parish, locality, region,
-                 city, municipality, borough, county, custom, country, state, district, neighborhood, province])
+            should_show_address = self._is_extra_info_in_place_names(title, address.place_names())
 
         else:
             should_show_address = True
@@ -319,19 +1312,18 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
         if should_show_address or postal_code:
 
             # Don't show borough, when street and city is present (more like modern address)
-            if self.omit_borough_from_address and street and (city or town):
-                borough = None
+            if self.omit_borough_from_address and address.street and (address.city or address.town):
+                address = address.replace(borough="")
 
             # Generate Address field from all the place types given
             if self.extended_pe_addresses:
-                address1 = self._make_comma_separated_address_string([street, unknown, custom,
-                                                                      department, building, farm, neighborhood])
-                address2 = self._make_comma_separated_address_string([hamlet, village, borough, locality])
-                city = self._make_comma_separated_address_string([municipality, town, city, parish])
-                state = self._make_comma_separated_address_string([district, province, region, county, state])
+                address1 = self._render_address_field('ADR1', address)
+                address2 = self._render_address_field('ADR2', address)
+                city = self._render_address_field('CITY', address)
+                state = self._render_address_field('STAE', address)
             else:
-                address1 = street
-                address2 = locality
+                address1 = address.street
+                address2 = address.locality
 
             # Write Address For the Place
             if address1 or address2 or state or postal_code:
@@ -352,25 +1344,213 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
         self._note_references(place.get_note_list(), level+1)
 
 
-    def _make_comma_separated_address_string(self, list_of_places):
-        ret = None
-        for place_name in list_of_places:
-            if place_name:
-                if ret:
+    def _get_gedcom_coordinates(self, handle):
+        """
+        Returns coordinates of the place in GEDCOM format, or (None, None) if
+        the place has no valid coordinates. Converted coordinates are kept in
+        a bounded cache, and converted again from the place table if needed.
+        """
+        if self._placeref_index is None:
+            self._index_places()
+        coordinates = self._coordinates.get(handle)
+        if coordinates is None:
+            coordinates = (None, None)
+            entry = self._resolver.get_entry(handle)
+            if entry is not None and entry[4] and entry[5]:
+                (ged_latitude, ged_longitude) = conv_lat_lon(entry[4], entry[5], "GEDCOM")
+                if ged_latitude and ged_longitude:
+                    coordinates = (ged_latitude, ged_longitude)
+            self._coordinates[handle] = coordinates
+        return coordinates
+
+    def _place_title(self, entries):
+        """
+        Returns the title of the first place in entries from
+        iter_place_entries, built from the loaded place entries. Only when
+        the titles are not generated from the place tree, the stored title
+        is read from the place.
+        """
+        return get_place_title((entry[:3] for entry in entries),
+                               self._get_stored_title).replace('\r', ' ')
+
+    def _get_stored_title(self, handle):
+        place = self._get_place(handle)
+        return place.get_title() if place is not None else ""
+
+    def _index_places(self):
+        """
+        Goes through all the places once per export, with a sequential scan
+        of the place table.
+
+        Name, type, enclosing place and coordinates of every place are loaded
+        into the place resolver of the database, so that place trees are walked
+        in memory instead of reading the places above from the database one
+        by one. Converts coordinates into GEDCOM format, so that each
+        coordinate string is parsed only once per export, and builds the
+        interval index of dated place references. Places with invalid or
+        incomplete coordinates are counted for the summary shown after the
+        export.
+
+        The place table, the place reference index and the aggregated
+        coordinates have an entry per place, also in streaming mode, so
+        their memory use grows with the number of places, not people.
+        """
+        self._coordinates.clear()
+        self._invalid_count = 0
+        self._invalid_coordinates = []
+        self._placeref_index = PlaceRefIndex()
+        decimal_coordinates = []
+        for place in self._resolver.load(self.dbase.iter_places()):
+            self.update()
+            self._placeref_index.add_place(place)
+            latitude = place.get_latitude()
+            longitude = place.get_longitude()
+            if not latitude and not longitude:
+                continue
+            if latitude and longitude:
+                (ged_latitude, ged_longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
+                if ged_latitude and ged_longitude:
+                    self._coordinates[place.handle] = (ged_latitude, ged_longitude)
+                    if self.aggregate_coordinates:
+                        (latitude, longitude) = conv_lat_lon(latitude, longitude, "D.D8")
+                        decimal_coordinates.append((place.handle, float(latitude), float(longitude)))
+                    continue
+            self._add_invalid_coordinates(place.get_gramps_id())
+
+        if self.aggregate_coordinates:
+            self._aggregate_coordinates(decimal_coordinates)
+
+    def _add_invalid_coordinates(self, gramps_id):
+        """
+        Counts a place with invalid coordinates, keeping only the GRAMPS IDs
+        listed in the summary
+        """
+        self._invalid_count += 1
+        ids = self._invalid_coordinates
+        if len(ids) < _MAX_REPORTED_PLACES or gramps_id < ids[-1]:
+            insort(ids, gramps_id)
+            del ids[_MAX_REPORTED_PLACES:]
+
+    def _aggregate_coordinates(self, decimal_coordinates):
+        """
+        Aggregates coordinates bottom-up in the current place tree.
 
-                    # omit place name that already exists (trying to avoid repetition)
-                    # (--)
-                    # Experimental feature
-                    if self.avoid_repetition_in_pe_addresses:
-                        test = " " + place_name + " "
-                        src = " " + ret + " "
-                        if src.find(test) >= 0:
-                            continue   # ok, omit
+        Each place's coordinates are added into the statistics of all the
+        places above it in a single pass. Places without coordinates of their
+        own get the centroid of the places within them, and a zoom level that
+        fits the spread of those coordinates.
 
-                    ret = ret + ", " + place_name
+        The centroid is the mean of the coordinates as unit vectors, and the
+        longitude spread is the smaller of the spreads measured from -180
+        and from 0 degrees, so that places on both sides of the 180th
+        meridian are aggregated correctly.
+        """
+        stats = {}
+        interval = self._today_interval
+        get_parent = self._placeref_index.get_parent
+        for handle, latitude, longitude in decimal_coordinates:
+            radians_latitude = math.radians(latitude)
+            radians_longitude = math.radians(longitude)
+            x = math.cos(radians_latitude) * math.cos(radians_longitude)
+            y = math.cos(radians_latitude) * math.sin(radians_longitude)
+            z = math.sin(radians_latitude)
+            # longitude in 0...360 degrees
+            east_longitude = longitude % 360.0
+            visited = set([handle])
+            parent = get_parent(handle, interval)
+            while parent is not None and parent not in visited:
+                visited.add(parent)
+                stat = stats.get(parent)
+                if stat is None:
+                    stats[parent] = [1, x, y, z, latitude, latitude, longitude, longitude,
+                                     east_longitude, east_longitude]
                 else:
-                    ret = place_name
-        return ret
+                    stat[0] += 1
+                    stat[1] += x
+                    stat[2] += y
+                    stat[3] += z
+                    stat[4] = min(stat[4], latitude)
+                    stat[5] = max(stat[5], latitude)
+                    stat[6] = min(stat[6], longitude)
+                    stat[7] = max(stat[7], longitude)
+                    stat[8] = min(stat[8], east_longitude)
+                    stat[9] = max(stat[9], east_longitude)
+                parent = get_parent(parent, interval)
+
+        self._aggregated_coordinates = {}
+        get_entry = self._resolver.get_entry
+        for handle, stat in stats.items():
+            entry = get_entry(handle)
+            if entry is not None and (entry[4] or entry[5]):
+                # coordinates are aggregated only for places that have none
+                continue
+            x, y, z = stat[1:4]
+            latitude = math.degrees(math.atan2(z, math.hypot(x, y)))
+            longitude = math.degrees(math.atan2(y, x))
+            (ged_latitude, ged_longitude) = conv_lat_lon("%.8f" % latitude, "%.8f" % longitude, "GEDCOM")
+            if ged_latitude and ged_longitude:
+                longitude_spread = min(stat[7] - stat[6], stat[9] - stat[8])
+                zoom = _zoom_level(stat[5] - stat[4], longitude_spread, latitude)
+                self._aggregated_coordinates[handle] = (ged_latitude, ged_longitude, zoom)
+
+    def _get_aggregated_coordinates(self, place):
+        """
+        Returns (latitude, longitude, zoom) aggregated from the places within
+        the place, or None
+        """
+        if self._placeref_index is None:
+            self._index_places()
+        aggregated = self._aggregated_coordinates.get(place.handle)
+        if aggregated and aggregated[2] is None:
+            # all the places within are in the same spot
+            aggregated = aggregated[:2] + (self._tng_place_level(place)[1],)
+        return aggregated
+
+    def _report_invalid_coordinates(self):
+        if not self._invalid_count:
+            return
+        count = self._invalid_count
+        place_ids = ", ".join(self._invalid_coordinates)
+        if count > _MAX_REPORTED_PLACES:
+            place_ids += ", ..."
+        LOG.warning("%d places with invalid coordinates: %s", count, place_ids)
+        self.user.warn(_("Invalid place coordinates"),
+                       _("%(count)d places in the database have invalid or incomplete "
+                         "coordinates. No MAP structure is written for them where "
+                         "they are used:\n%(places)s")
+                       % {'count': count, 'places': place_ids})
+
+    def _render_address_field(self, tag, values):
+        """
+        Renders an address field from its compiled template
+        """
+        compiled_format = self._address_templates[tag]
+        if self.avoid_repetition_in_pe_addresses:
+            values = self._omit_repeated_names(compiled_format.key_order, values)
+        return compiled_format.render(values) or None
+
+    def _omit_repeated_names(self, keys, values):
+        """
+        Returns the values of the keys as LazyValues, where a place name
+        that already exists in the names of the keys before it is omitted
+        (trying to avoid repetition). A name is only checked when the
+        template reaches its key. Experimental feature.
+        """
+        def provider(index):
+            def get_name():
+                place_name = values.get(keys[index]) or ""
+                if place_name:
+                    test = " " + place_name + " "
+                    for key in keys[:index]:
+                        name = unique_values.get(key)
+                        if name and (" " + name + " ").find(test) >= 0:
+                            return ""
+                return place_name
+            return get_name
+
+        unique_values = LazyValues(dict((key, provider(index))
+                                        for index, key in enumerate(keys)))
+        return unique_values
 
     def _is_extra_info_in_place_names(self, place_title, list_of_places):
         """
@@ -387,48 +1567,87 @@ class GedcomWriterExtension(exportgedcom.GedcomWriter):
 
         return ret
 
-    def get_place_list(self, place, date=None):
+    def iter_place_entries(self, place, date=None):
         """
-        Returns a list of all places in place tree
+        Generates (handle, name, type, latitude, longitude) of the place and
+        all the places above it in place tree at the given date (today if
+        the date is missing or empty), without reading the places above from
+        the database
         """
-
-        db = self.dbase
-
-        if date is None:
-            date = Today()
-        visited = [place.handle]
-        lines = [place]
+        if self._placeref_index is None:
+            self._index_places()
+        if date is None or date.is_empty():
+            interval = self._today_interval
+        else:
+            interval = date_interval(date)
+        get_parent = self._placeref_index.get_parent
+        get_entry = self._resolver.get_entry
+        handle = place.handle
+        visited = set([handle])
+        yield (handle, place.get_name(), place.get_type(),
+               place.get_latitude(), place.get_longitude())
         while True:
-            handle = None
-            for placeref in place.get_placeref_list():
-                ref_date = placeref.get_date_object()
-                if ref_date.is_empty() or date.match(ref_date):
-                    handle = placeref.ref
+            handle = get_parent(handle, interval)
             if handle is None or handle in visited:
-                break
-            place = db.get_place_from_handle(handle)
-            if place is None:
-                break
-            visited.append(handle)
-            lines.append(place)
-        return lines
+                return
+            entry = get_entry(handle)
+            if entry is None:
+                return
+            visited.add(handle)
+            yield handle, entry[0], entry[1], entry[4], entry[5]
+
+    def get_location(self, place, date=None):
+        """
+        Returns a dictionary of place types and names of the place tree
+        at the given date, like get_main_location does
+        """
+        location = {}
+        for handle, name, place_type, latitude, longitude \
+                in self.iter_place_entries(place, date):
+            if not place_type.is_custom():
+                location[int(place_type)] = name
+        return location
+
+    def get_place_address(self, place, date=None):
+        """
+        Returns the address keys of the place tree at the given date
+        as a PlaceAddress
+        """
+        if not self._resolver.is_dated(place):
+            return self._resolver.get_address(place)
+        hierarchy = (entry[:3] for entry in self.iter_place_entries(place, date))
+        return PlaceAddress.from_hierarchy(hierarchy, place.get_code())
+
+    def _get_place(self, handle):
+        """
+        Returns place by handle using the bounded place cache
+        """
+        place = self._place_cache.get(handle)
+        if place is None:
+            place = self.dbase.get_place_from_handle(handle)
+            if place is not None:
+                self._place_cache[handle] = place
+        return place
 
     def _tng_place_level(self, place):
+        return self._tng_type_level(place.get_type())
+
+    def _tng_type_level(self, place_type):
         level = 6
         zoom = 9
-        if place.get_type() in self._unknown_level_place_types:
+        if place_type in self._unknown_level_place_types:
             level, zoom = 1, 13
-        if place.get_type() in self._address1_level_place_types:
+        if place_type in self._address1_level_place_types:
             level, zoom = 1, 13
-        if place.get_type() in self._address2_level_place_types:
+        if place_type in self._address2_level_place_types:
             level, zoom = 2, 11
-        if place.get_type() in self._city_level_place_types:
+        if place_type in self._city_level_place_types:
             level, zoom = 3, 9
-        if place.get_type() in self._county_level_place_types:
+        if place_type in self._county_level_place_types:
             level, zoom = 4, 7
-        if place.get_type() is PlaceType.STATE:
+        if place_type is PlaceType.STATE:
             level, zoom = 5, 5
-        if place.get_type() is PlaceType.COUNTRY:
+        if place_type is PlaceType.COUNTRY:
             level, zoom = 6, 4
         return level, zoom
 
@@ -463,6 +1682,18 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.omit_borough_from_address_check = None
         self.move_patronymics = 1
         self.move_patronymics_check = None
+        self.stream_records = 1
+        self.stream_records_check = None
+        self.aggregate_coordinates = 1
+        self.aggregate_coordinates_check = None
+        self.show_progress_window = 0
+        self.show_progress_window_check = None
+        self.memory_profile = 0
+        self.memory_profile_check = None
+        self.shard_count = 1
+        self.shard_count_spin = None
+        self.address_formats = dict((tag, fmt) for tag, label, fmt in ADDRESS_FORMATS)
+        self.address_format_entries = {}
 
     def get_option_box(self):
         option_box = super(GedcomWriterOptionBox, self).get_option_box()
@@ -482,6 +1713,14 @@ class GedcomWriterOptionBox(WriterOptionBox):
             Gtk.CheckButton(_("Include TNG specific place level tags 'PLEV' and 'ZOOM'"))
         self.move_patronymics_check = \
             Gtk.CheckButton(_("Move matro-/patronynic surnames to forename"))
+        self.stream_records_check = \
+            Gtk.CheckButton(_("Stream records to keep memory use low with large databases"))
+        self.aggregate_coordinates_check = \
+            Gtk.CheckButton(_("Calculate missing coordinates from places within the place"))
+        self.show_progress_window_check = \
+            Gtk.CheckButton(_("Show progress in a window that allows cancelling the export"))
+        self.memory_profile_check = \
+            Gtk.CheckButton(_("Write a memory use report next to the GEDCOM file"))
 
         # Set defaults:
         self.get_coordinates_check.set_active(1)
@@ -491,6 +1730,16 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.include_tng_place_levels_check.set_active(0)
         self.omit_borough_from_address_check.set_active(0)
         self.move_patronymics_check.set_active(1)
+        self.stream_records_check.set_active(1)
+        self.aggregate_coordinates_check.set_active(0)
+        self.show_progress_window_check.set_active(0)
+        self.memory_profile_check.set_active(0)
+        self.stream_records_check.set_tooltip_text(
+            _("People and families are read one at a time. Place data is "
+              "still kept for all places, so memory use grows with the "
+              "number of places."))
+        # tracemalloc is not available in Python 2
+        self.memory_profile_check.set_sensitive(tracemalloc is not None)
 
         # Add to gui:
         option_box.pack_start(self.move_patronymics_check, False, False, 0)
@@ -499,7 +1748,36 @@ class GedcomWriterOptionBox(WriterOptionBox):
         option_box.pack_start(self.omit_borough_from_address_check, False, False, 0)
         option_box.pack_start(self.avoid_repetition_in_pe_addresses_check, False, False, 0)
         option_box.pack_start(self.get_coordinates_check, False, False, 0)
+        option_box.pack_start(self.aggregate_coordinates_check, False, False, 0)
         option_box.pack_start(self.include_tng_place_levels_check, False, False, 0)
+        option_box.pack_start(self.stream_records_check, False, False, 0)
+        option_box.pack_start(self.show_progress_window_check, False, False, 0)
+        option_box.pack_start(self.memory_profile_check, False, False, 0)
+
+        # Sharded output:
+        self.shard_count_spin = Gtk.SpinButton.new_with_range(1, _MAX_SHARD_COUNT, 1)
+        self.shard_count_spin.set_value(1)
+        self.shard_count_spin.set_tooltip_text(
+            _("Records are split into files by GRAMPS ID range. All files have "
+              "the same header, and the ID ranges of the files are listed "
+              "in a manifest file."))
+        hbox = Gtk.HBox()
+        hbox.pack_start(Gtk.Label(label=_("Number of GEDCOM files") + ':'), False, False, 5)
+        hbox.pack_start(self.shard_count_spin, False, False, 0)
+        option_box.pack_start(hbox, False, False, 0)
+
+        # Address templates:
+        keys_tooltip = _("Address template. Available keys: %s") % \
+            ", ".join("%" + key for key in PLACE_KEYS)
+        for tag, label, fmt in ADDRESS_FORMATS:
+            entry = Gtk.Entry()
+            entry.set_text(self.address_formats[tag])
+            entry.set_tooltip_text(keys_tooltip)
+            self.address_format_entries[tag] = entry
+            hbox = Gtk.HBox()
+            hbox.pack_start(Gtk.Label(label=label + ':'), False, False, 5)
+            hbox.pack_start(entry, True, True, 0)
+            option_box.pack_start(hbox, False, False, 0)
 
 
         # Return option box:
@@ -524,6 +1802,20 @@ class GedcomWriterOptionBox(WriterOptionBox):
             self.omit_borough_from_address = self.omit_borough_from_address_check.get_active()
         if self.move_patronymics_check:
             self.move_patronymics = self.move_patronymics_check.get_active()
+        if self.stream_records_check:
+            self.stream_records = self.stream_records_check.get_active()
+        if self.aggregate_coordinates_check:
+            self.aggregate_coordinates = self.aggregate_coordinates_check.get_active()
+        if self.show_progress_window_check:
+            self.show_progress_window = self.show_progress_window_check.get_active()
+        if self.memory_profile_check:
+            self.memory_profile = self.memory_profile_check.get_active()
+        if self.shard_count_spin:
+            self.shard_count = self.shard_count_spin.get_value_as_int()
+        for tag, label, fmt in ADDRESS_FORMATS:
+            entry = self.address_format_entries.get(tag)
+            if entry:
+                self.address_formats[tag] = entry.get_text().strip() or fmt
 
 
 def export_data(database, filename, user, option_box=None):
@@ -540,756 +1832,3 @@ def export_data(database, filename, user, option_box=None):
     except DatabaseError as msg:
         user.notify_db_error(_("Export failed"), msg)
     return ret
-
-
-# FORMAT STRING PARSER
-# v0.8.1
-#
-# Parses format string with key coded values in dictionary removing unnecessary separators between parsed names
-#
-# (C) 2015  Kati Haapamaki
-#
-# ToDo:
-# methods to change default enclosing chars
-
-
-"""
-    FORMAT STRING PARSER
-
-    Parses a format string by replacing keywords with string values provided in a dictionary.
-
-    Automatically removes characters between keywords that yields empty values.
-    Parts of format string are processed separately, when they are enclosed by enclosing brackets that are
-    by default [<{}>].
-
-    Enclosing brackets has different meanings:
-        [ ]     ANY enclosure. Any single keyword in square brackets that yields non empty string makes to show contents
-        < >     ALL enclosure. All keywords in angle brackets must yield non empty strings to show contents
-        { }     ALWAYS enclosure. Contents enclosed with braces are always shown, regardless of keyword parsing
-                Can be used to force to show characters
-
-    Option operator:
-        |       Single | character without any spaces around makes only first non empty keyword to be shown
-
-    Binding operator:
-        -+      Binds right, element right is parsed only if element left yields non empty
-        +-      Binds left, element left is parsed only if element right yields non empty
-
-    Other operators: (not implemented)
-        $u      Convert to uppercase
-        $s      Convert to sentence case
-        $t      Convert to title case
-        $l      Convert to lowercase
-        $1      Convert to sentence case byt skipping over preceding numeric characters
-        $2      Convert to title case and capitalize letters after any non alphabetic character
-
-    Example:
-        keys and values =
-            lunch = "lunch"
-            dinner = "dinner"
-            meat = "lamb"
-            rice = ""
-            potatoes = "french fries"
-            vegetables = "carrots and broccoli"
-            extra = ""
-            drink = "sparkling water"
-            dessert = "ice-cream"
-            fruit = "apple"
-            coffee = "black coffee"
-            tea = ""
-
-        format string =
-            <%LUNCH|%DINNER: [$s%meat, %rice|%potatoes, %vegetables, %extra,
-                %drink]>-+[ (Dessert: $s[%dessert|%fruit, %coffee|%tea])]
-        result:
-            LUNCH: Lamb, french fries, carrots and broccoli, sparkling water (Dessert: Ice-cream, black coffee)
-
-        note:
-            fruit keyword yields empty because it's optional with desert and desert has priority as it comes first
-            If both keywords 'lunch' and 'dinner' are empty, the first part (main course) is not shown due to
-            all-enclosure < >, and second part (dessert) is not shown either because it is bound with binding operator
-            -+ to the first part, which is empty.
-"""
-
-class ElementType():
-    KEY = 0
-    SEPARATOR = 2
-    PREFIX = 3
-    SUFFIX = 4
-    PARSED = 1
-    PLAINTEXT = 5
-    OPTIONOPERATOR = 6
-    BINDOPERATOR = 7
-
-
-class Case():
-    NONE = 0
-    UPPERCASE = 1
-    LOWERCASE = 2
-    SENTENCECASE = 3
-    TITLECASE = 4
-    SENTENCECASENUMSKIP = 5
-    TITLECASENUMSKIP = 6
-
-
-class ParseMode():
-    ALWAYS = 0
-    IFANY = 1
-    IFALL = 2
-
-
-class FormatStringParser():
-    """
-
-    """
-    _all_keys = []
-    _key_prefix = "%"
-    _enc_any_start = '['
-    _enc_any_end = ']'
-    _enc_all_start = '<'
-    _enc_all_end = '>'
-    _enc_always_start = '{'
-    _enc_always_end = '}'
-    _escape_char = "\\"
-    _optional_operator = '|'
-    _add_right_operator = '-+'
-    _add_left_operator = '+-'
-    _uppercase_operator = "$u"
-    _lowercase_operator = "$l"
-    _sentencecase_operator = "$s"
-    _titlecase_operator = "$t"
-    _sentencecase_numskip_operator = "$1"
-    _titlecasenumskip_operator = "$2"
-
-    def __init__(self, key_list=None):
-        if not key_list:
-            self._all_keys = []
-        else:
-            self.set_keys(key_list)
-
-    def set_keys(self, key_list):
-        """
-
-        :param key_list:
-        :return:
-        """
-        self._all_keys = []
-        if type(key_list) is list:
-            self._all_keys = key_list
-        elif type(key_list) is dict:
-            for key, value in key_list.items():
-                self._all_keys.append(key)
-        else:
-            raise TypeError("Incorrect key list type")
-
-    def append_keys(self, key_list):
-        """
-
-        :param key_list:
-        :return:
-        """
-        if type(key_list) is list:
-            self._all_keys.append(key_list)
-        elif type(key_list) is dict:
-            for key, value in key_list.items():
-                if not self._has_item(key, self._all_keys):
-                    self._all_keys.append(key)
-
-    def parse(self, values, format_string):
-        """
-        The main method to get work done. Call it from outside class.
-
-        :param values:          The dictionary including all keywords to be replaced in the format string
-        :param format_string:   The format string to be parsed
-        :return:                Parsed string
-        """
-
-        self.append_keys(values)
-        parsed_list = self._parse_full_format_string(values, format_string)
-        parsed_list = self._collect(parsed_list)
-        return self._make_string_from_tuple_list(parsed_list)
-
-    def _has_item(self, item, list_):
-        """
-
-        :param item:
-        :param list_:
-        :return:
-        """
-        for item_in_list in list_:
-            if item == item_in_list:
-                return True
-        return False
-
-    def _parse_full_format_string(self, values, format_string, mode=ParseMode.IFANY, case=Case.NONE):
-        """
-        Recurses format string's enclosed parts, and parses them into tuple list.
-        Returns tuple list of elements of partial format string when going through recursion
-        Finally returns tuple list that is suppressed to single item including the full parsed string
-
-        :param values:
-        :param format_string:
-        :param mode:
-        :return:
-        """
-        new_case = Case.NONE
-        if format_string:
-                c = format_string[0:2]
-                if c == self._uppercase_operator:
-                    new_case = Case.UPPERCASE
-                elif c == self._sentencecase_operator:
-                    new_case = Case.SENTENCECASE
-                elif c == self._sentencecase_numskip_operator:
-                    new_case = Case.SENTENCECASENUMSKIP
-                elif c == self._titlecase_operator:
-                    new_case = Case.TITLECASE
-                elif c == self._titlecasenumskip_operator:
-                    new_case = Case.TITLECASENUMSKIP
-                elif c == self._lowercase_operator:
-                    new_case = Case.LOWERCASE
-                if new_case != Case.NONE:
-                    format_string = format_string[2:]
-                    case = new_case
-
-        if case == Case.SENTENCECASENUMSKIP or case == Case.SENTENCECASE:
-            sentence_case = case
-            case = Case.NONE
-        else:
-            sentence_case = case
-
-        enclosing_start = self._find_enclosing_start(format_string)
-        if enclosing_start:
-            start_pos = enclosing_start[0]
-
-            if start_pos >= 0:
-                enclosing_end = self._find_enclosing_end(format_string, enclosing_start)
-                if enclosing_end:
-                    end_pos = enclosing_end[0]
-                    enclosed_mode = enclosing_end[1]
-                    # Divide in parts. Middle is part that is enclosed with brackets, 'before' and 'after' are around it
-                    before = format_string[:start_pos] if start_pos > 0 else ""
-                    middle = format_string[start_pos + 1:end_pos] if end_pos - start_pos >= 2 else ""
-                    after = format_string[end_pos + 1:] if end_pos < len(format_string) - 1 else ""
-
-                    #print("//" + before + "//" + middle + "//" + after + "//")
-                    recursion = self._parse_full_format_string(values, before, mode, sentence_case) \
-                        + self._collect(self._parse_full_format_string(values, middle, enclosed_mode, case),
-                                        enclosed_mode) \
-                        + self._parse_full_format_string(values, after, mode, case)
-
-                    return recursion
-
-        new_tuple_list = self._parse_format_into_list(values, format_string, sentence_case)
-
-        return new_tuple_list
-
-    def _parse_format_into_list(self, values, format_string, case=Case.NONE):
-        """
-        Splits format string into tuple list, and then parses keys included in it
-
-
-        :param values:          Values to be parsed in key/value dictionary
-        :param format_string:   The format string to be parsed
-        :return:                The format string splitted into elements in a list containing tuples
-        """
-        tuple_list = self._split_format_string_into_tuple_list(format_string, case)
-        parsed_list = self._parse_keys_in_list(values, tuple_list, case)
-        return parsed_list
-
-    def _split_format_string_into_tuple_list(self, format_string, case=Case.NONE):
-        """
-        Splits format string into tuple list
-
-        :param format_string:   The format string to be parsed
-        :return:                The format string splitted into elements in a list containing tuples
-
-
-        Tuples has format:
-            ((key as string, formatted key as string), item type as ElementType, case as Case) ...for key element
-                or
-            (item as string, item type as ElementType, case as Case) ...for separators, operators and parsed keys
-
-        case is for case conversion, and it will be passed along to be able to make case conversion at correct point
-
-        """
-        tuple_list = []
-        remainder = format_string
-        any_key_found = False
-        if remainder:
-            while remainder:
-                next_key = self._get_next_key(remainder)
-                if next_key:
-                    before, formatted_key, after = remainder.partition(self._key_prefix + next_key[1])
-                    if before:
-                        if before == self._optional_operator:
-                            separator_tuple = (before, ElementType.OPTIONOPERATOR, case)
-                        elif before == self._add_right_operator or before == self._add_left_operator:
-                            separator_tuple = (before, ElementType.BINDOPERATOR, case)
-                        else:
-                            if any_key_found:
-                                separator_tuple = (before, ElementType.SEPARATOR, case)
-                            else:
-                                separator_tuple = (before, ElementType.PREFIX, case)
-
-                        tuple_list.append(separator_tuple)
-
-                    key_tuple = (next_key, ElementType.KEY, case)
-                    tuple_list.append(key_tuple)
-                    any_key_found = True
-                    remainder = after
-                else:
-                    if remainder == self._optional_operator:
-                        separator_tuple = (remainder, ElementType.OPTIONOPERATOR, case)
-                    elif remainder == self._add_right_operator or remainder == self._add_left_operator:
-                        separator_tuple = (remainder, ElementType.BINDOPERATOR, case)
-                    else:
-                        if any_key_found:
-                            separator_tuple = (remainder, ElementType.SUFFIX, case)
-                        else:
-                            separator_tuple = (remainder, ElementType.PLAINTEXT, case)
-
-                    tuple_list.append(separator_tuple)
-                    remainder = ""
-
-        return tuple_list
-
-    def _get_next_key(self, format_string):
-        """
-        Searches for the first key in a format string
-
-        Search is case-insensitive and because of that, the method returns a tuple of which first item is
-        the key in format that it is appears in the key list, and the second item is the key in format it
-        appears in the format string
-
-        If no key is found, the method returns None
-
-        :param format_string:   The format string
-        :return:                A tuple of the next key and its formatted version
-        """
-        any_found = False
-        lowest_index = -1
-        found_formatted_key = ""
-        found_true_key = ""
-        check_string = format_string.lower()
-
-        if format_string:
-            for key in self._all_keys:
-                check_key = self._key_prefix + key.lower()
-                found_pos = check_string.find(check_key, 0)
-                if found_pos >= 0 and (found_pos < lowest_index or not any_found):
-                    char_before = format_string[found_pos-1] if found_pos > 0 else ""
-                    if char_before != self._escape_char:
-                        lowest_index = found_pos
-                        any_found = True
-                        found_true_key = key
-                        found_formatted_key = format_string[lowest_index:lowest_index+len(check_key)]
-        if any_found:
-            return found_true_key, found_formatted_key[len(self._key_prefix):]
-        else:
-            return None
-
-    def _parse_keys_in_list(self, values, tuple_list, inherited_case=Case.NONE):
-        """
-        Parses all the keys in the tuple list by using values given in key/value dictionary
-        Also does case conversion if needed, but not the sentence case conversion, because that cannot be done yet
-
-        :param values:
-        :param tuple_list:
-        :param inherited_case:
-        :return:
-        """
-        if len(tuple_list) < 1:
-            return []
-        new_list = []
-        index = 0
-
-        #case_from_formatting = Case.NONE
-        #cases = [Case.NONE, Case.UPPERCASE, Case.SENTENCECASE, Case.LOWERCASE]
-
-        for item_master, item_type, case in tuple_list:
-            if type(item_master) is tuple:                  # item_master may be a tuple or just a string
-                item = item_master[0]                           # actual key
-                item_formatted = item_master[1]                 # formatted key
-            else:
-                item = item_formatted = item_master         # not a key (formatted key concept doesn't apply here)
-
-            if case == Case.NONE:
-                case = inherited_case
-
-            if item_type is not ElementType.KEY:
-                if case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
-                    parsed_value = (item, item_type, case)      # Cannot make sentence case op yet. Leave it for later
-                else:
-                    parsed_value = (self._convert_case(item, case), item_type, case)
-
-                new_list.append(parsed_value)
-            else:
-                value = values.get(item)                            # get value for key and set to "" if not existing
-                if not value:
-                    value = ""
-
-                case_from_formatting = self._get_case(item_formatted)  # key's case as it appears in the format string
-                if item == item_formatted and case != Case.NONE:    # if no case difference between actual key
-                    case_from_formatting = Case.NONE                # and formatted key, set tag case conversion to none
-
-                if case_from_formatting != Case.NONE:               # if formatting defines case conversion, use it
-                    case = case_from_formatting                     # instead of using inherited case
-
-                if case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
-                    # parse, but leave sentence case operation for later
-                    parsed_value = (value, ElementType.PARSED, case)
-                else:
-                    # parse and make case conversion
-                    parsed_value = (self._convert_case(value, case), ElementType.PARSED, case)
-                new_list.append(parsed_value)
-
-            index += 1
-
-        return new_list
-
-    def _convert_case(self, string, case):
-        """
-
-        :param string:
-        :param case:
-        :return:
-        """
-        if not string:
-            return ""
-
-        if case == Case.UPPERCASE:
-            return string.upper()
-        elif case == Case.LOWERCASE:
-            return string.lower()
-        elif case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
-            pos = self._find_first_alphanum(string) if case == Case.SENTENCECASE else self._find_first_alpha(string)
-            if pos >= 0:
-                before = string[:pos] if pos > 0 else ""
-                after = string[pos+1:] if len(string) > pos + 1 else ""
-                return before + string[pos].upper() + after
-            else:
-                return string
-        elif case == Case.TITLECASE or case == Case.TITLECASENUMSKIP:
-            prev_c = " "
-            new_string = ""
-            for c in string:
-                if not prev_c.isalnum() and case == Case.TITLECASE\
-                        or prev_c == " " and case == Case.TITLECASENUMSKIP:
-                    new_string = new_string + c.upper()
-                else:
-                    new_string = new_string + c
-                prev_c = c
-            return new_string
-        else:
-            return string
-
-    def _find_first_alphanum(self, string):
-        index = 0
-        if not string:
-            return -1
-        for c in string:
-            if c.isalnum():
-                return index
-            index += 1
-        return -1
-
-    def _find_first_alpha(self, string):
-        index = 0
-        if not string:
-            return -1
-        for c in string:
-            if c.isalpha():
-                return index
-            index += 1
-        return -1
-
-    def _get_case(self, string):
-        cases = [Case.LOWERCASE, Case.UPPERCASE, Case.SENTENCECASE, Case.SENTENCECASENUMSKIP,
-                 Case.TITLECASE, Case.TITLECASENUMSKIP]
-        for case in cases:
-            if string == self._convert_case(string, case):
-                return case
-        return Case.NONE
-
-    def _make_string_from_tuple_list(self, tuple_list):
-        str_list = []
-        for item, mode, case in tuple_list:
-            str_list.append(item)
-        return "".join(str_list)
-
-    def _collect(self, tuple_list, mode=ParseMode.IFANY, case=Case.NONE):
-        """
-        One of they key methods. Suppresses a tuple list to length of 1 by processing all operators and
-        disregarding empty parsed strings and separators between them
-
-        :param tuple_list:  A tuple list
-        :return:            A tuple list with single item
-        """
-        string_list = []
-        index = 0
-        any_parsed = False
-
-        # change prefix and suffixes to separators if they are no longer in the beginning or in the end
-        tuple_list = self._fix_separators(tuple_list)
-
-        # process optional and binding operators
-        tuple_list = self._handle_operators(tuple_list)
-        first_item_case = Case.NONE  # will be used if there is need to make case conversion to sentence case
-
-        for item, item_type, case in tuple_list:
-            if index == 0:
-                first_item_case = case
-
-            if item_type == ElementType.PARSED:
-                any_parsed = True
-
-            if (item_type == ElementType.PARSED or item_type == ElementType.PLAINTEXT) and item:
-                string_list.append(item)
-
-                separator1 = separator2 = None
-                found_more = False
-
-                if len(tuple_list) > index + 2:
-                    if tuple_list[index+1][1] == ElementType.SEPARATOR:
-                        separator1 = tuple_list[index + 1]
-                    index2 = index + 1
-
-                    # look for the next parsed value to determine what separators to use
-                    for item2, type2, case2 in tuple_list[index+1:]:
-                        if (type2 == ElementType.PARSED or type2 == ElementType.PLAINTEXT) and item2:
-                            found_more = True
-                            if index2 > index + 2 and tuple_list[index2 - 1][1] == ElementType.SEPARATOR:
-                                separator2 = tuple_list[index2 - 1]
-                            break
-                        index2 += 1
-
-                    separator = separator1 if separator1 else separator2  # prefer using first separator, if two exists
-
-                    if separator and found_more:
-                        string_list.append(separator[0])
-
-            elif item_type == ElementType.SEPARATOR:
-                pass
-
-            elif item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX:
-                string_list.append(item)
-
-            index += 1
-
-        parsed_items = self._number_of_non_empty_parsed_item(tuple_list)
-        empty_items = self._number_of_empty_parsed_item(tuple_list)
-
-        if mode == ParseMode.IFANY and parsed_items > 0 \
-                or mode == ParseMode.ALWAYS \
-                or mode == ParseMode.IFALL and parsed_items > 0 and empty_items == 0:
-
-            parsed_string = "".join(string_list)
-            if parsed_string:
-                if parsed_string.find(self._escape_char) >= 0:
-                    parsed_string = self._handle_escape_char(parsed_string)
-                # execute sentence case conversion here - later than other conversions,
-                # because we need completely parsed string to do that
-                if first_item_case == Case.SENTENCECASE or first_item_case == Case.SENTENCECASENUMSKIP:
-                   parsed_string = self._convert_case(parsed_string, first_item_case)
-        else:
-            parsed_string = ""
-
-        return[(parsed_string, ElementType.PARSED if any_parsed else ElementType.PLAINTEXT, case)]
-
-    def _fix_separators(self, tuple_list):
-        """
-        Should be used to convert suffixes and prefixes that origin from enclosed parts of format string
-        into separators. Must be done before collect/suppress. Working ok?
-
-        :param tuple_list:
-        :return:
-        """
-        index = 0
-        new_tuple_list = []
-        for item, item_type, case in tuple_list:
-            if index > 0 and index < len(tuple_list) - 1 \
-                    and (item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX):
-                new_tuple = (item, ElementType.SEPARATOR, case)
-            else:
-                new_tuple = (item, item_type, case)
-            new_tuple_list.append(new_tuple)
-            index += 1
-        return new_tuple_list
-
-    def _handle_operators(self, tuple_list):
-        skip_next = False
-        index = 0
-        new_tuple_list = []
-        for item, item_type, case in tuple_list:
-            skip_this = False
-            if not skip_next:
-
-                if item_type == ElementType.OPTIONOPERATOR \
-                        and index > 0 and index < len(tuple_list) - 1:
-                    prev_item = new_tuple_list[len(new_tuple_list)-1][0]
-                    prev_item_type = new_tuple_list[len(new_tuple_list)-1][1]
-                    next_item = tuple_list[index+1][0]
-                    next_item_type = tuple_list[index+1][1]
-                    if (prev_item_type == ElementType.PARSED) \
-                            and (next_item_type == ElementType.PARSED):
-                        if not prev_item:
-                            del new_tuple_list[len(new_tuple_list)-1]  # if prev item empty, delete along operator
-                            skip_this = True
-                        else:
-                            skip_next = skip_this = True    # or else omit next, along operator
-                elif item_type == ElementType.BINDOPERATOR:
-                    if item == self._add_right_operator:
-                        if index > 0 and index < len(tuple_list) - 1 \
-                                and not new_tuple_list[len(new_tuple_list)-1][0] \
-                                and new_tuple_list[len(new_tuple_list)-1][1] == ElementType.PARSED \
-                                and tuple_list[index+1][1] == ElementType.PARSED:
-                            skip_next = skip_this = True
-                    if item == self._add_left_operator:
-                        if index > 0 and index < len(tuple_list) - 1 \
-                                and not tuple_list[index+1][0] \
-                                and new_tuple_list[len(new_tuple_list)-1][1] == ElementType.PARSED \
-                                and tuple_list[index+1][1] == ElementType.PARSED:
-                            del new_tuple_list[len(new_tuple_list)-1]
-                            skip_this = True
-                if not skip_this:
-                    new_tuple = (item, item_type, case)
-                    new_tuple_list.append(new_tuple)
-            else:
-                skip_next = False
-            index += 1
-        return new_tuple_list
-
-    def _handle_escape_char(self, string):
-        index = 0
-        new_string = []
-        while index < len(string):
-            if string[index] == self._escape_char:
-                if index < len(string) -1:
-                    if string[index+1] != self._escape_char:
-                        pass
-                    else:
-                        new_string.append(string[index])
-                else:
-                    pass
-            else:
-                new_string.append(string[index])
-            index += 1
-        return "".join(new_string)
-
-    def _number_of_empty_parsed_item(self, tuple_list):
-        """
-
-        :param tuple_list:
-        :return:
-        """
-        counter = 0
-        for item, item_type, case in tuple_list:
-            if item_type == ElementType.PARSED and not item:
-                counter += 1
-        return counter
-
-    def _number_of_non_empty_parsed_item(self, tuple_list):
-        """
-
-        :param tuple_list:
-        :return:
-        """
-        counter = 0
-        for item, item_type, case in tuple_list:
-            if item_type == ElementType.PARSED and item:
-                counter += 1
-        return counter
-
-    def _find_enclosing_start(self, format_string, start_pos=0):
-        """
-
-        :param format_string:
-        :param start_pos:
-        :return:
-        """
-        index = start_pos
-        found_enclosing = None
-        for c in format_string[start_pos:]:
-            if c == self._enc_any_start:
-                found_enclosing = index, ParseMode.IFANY
-            elif c == self._enc_all_start:
-                found_enclosing = index, ParseMode.IFALL
-            elif c == self._enc_always_start:
-                found_enclosing = index, ParseMode.ALWAYS
-            if found_enclosing:
-                if index > start_pos:
-                    if format_string[index-1] == self._escape_char:
-                        found_enclosing = None # omit found enclosing if it's followed by escape char
-                    else:
-                        break
-                else:
-                    break
-
-            index += 1
-
-        return found_enclosing
-
-    def _find_enclosing_end(self, format_string, enclosing_start):
-        """
-
-        :param format_string:
-        :param enclosing_start:
-        :return:
-        """
-        start_pos = enclosing_start[0] + 1
-        found_enclosing_end = None
-
-        if len(format_string)- start_pos > 1:
-
-            mode = enclosing_start[1]
-            if mode == ParseMode.IFALL:
-                ec_end_char = self._enc_all_end
-                ec_start_char = self._enc_all_start
-            elif mode == ParseMode.ALWAYS:
-                ec_end_char = self._enc_always_end
-                ec_start_char = self._enc_always_start
-            else:
-                ec_end_char = self._enc_any_end
-                ec_start_char = self._enc_any_start
-
-            index = start_pos
-            level = 0
-            for c in format_string[start_pos:]:
-                if c == ec_end_char:
-                    if level == 0 and c == ec_end_char:
-                        found_enclosing_end = index, mode
-                        break
-                    else:
-                        level -= 1
-                        if index > start_pos:
-                            if format_string[index-1] == self._escape_char:
-                                level += 1 # was escape, step back
-                elif c == ec_start_char:
-                    level += 1
-                    if index > start_pos:
-                        if format_string[index-1] == self._escape_char:
-                            level -= 1 # was escape, step back
-
-                index += 1
-
-        return found_enclosing_end
-
-    def _is_enclosing_start_char(self, c):
-        """
-
-        :param c:
-        :return:
-        """
-        if not c:
-            return False
-        return c == self._enc_all_start or c == self._enc_any_start or c == self._enc_always_start
-
-    def _is_enclosing_end_char(self, c):
-        if not c:
-            return False
-        return c == self._enc_all_end or c == self._enc_any_end or c == self._enc_always_end
-
-    def _is_enclosing_char(self, c):
-        return self._is_enclosing_start_char(c) or self._is_enclosing_end_char(c)
-
-
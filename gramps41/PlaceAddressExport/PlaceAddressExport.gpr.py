@@ -0,0 +1,59 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2015 Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+#------------------------------------------------------------------------
+#
+# Place address exports
+#
+#------------------------------------------------------------------------
+
+register(EXPORT,
+    id    = 'Place Addresses CSV',
+    name  = _("Place Addresses (CSV)"),
+    name_accell  = _("Place Addresses as _CSV"),
+    description =  _("Exports the address fields of all places as comma separated values."),
+    version = '0.1.0',
+    gramps_target_version = '4.1',
+    status = STABLE,
+    fname = 'PlaceAddressExport.py',
+    export_function = 'export_csv',
+    export_options = 'WriterOptionBox',
+    export_options_title = _('Place address export options'),
+    extension = "csv",
+    depends_on = ["libplaceaddress"],
+)
+
+register(EXPORT,
+    id    = 'Place Addresses JSONL',
+    name  = _("Place Addresses (JSON Lines)"),
+    name_accell  = _("Place Addresses as _JSON Lines"),
+    description =  _("Exports the address fields of all places as JSON objects, one per line."),
+    version = '0.1.0',
+    gramps_target_version = '4.1',
+    status = STABLE,
+    fname = 'PlaceAddressExport.py',
+    export_function = 'export_jsonl',
+    export_options = 'WriterOptionBox',
+    export_options_title = _('Place address export options'),
+    extension = "jsonl",
+    depends_on = ["libplaceaddress"],
+)
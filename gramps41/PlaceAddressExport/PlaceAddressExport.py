@@ -0,0 +1,144 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2015       Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+"""
+Exports the addresses that the AddressPreview gramplet shows, for all the
+places, as CSV or JSON Lines.
+"""
+from __future__ import unicode_literals
+
+import io
+import sys
+import csv
+import json
+from collections import OrderedDict
+
+from gramps.gen.const import GRAMPS_LOCALE as glocale
+from gramps.gen.errors import DatabaseError
+from gramps.gen.updatecallback import UpdateCallback
+from gramps.gui.plug.export import WriterOptionBox
+
+from libplaceaddress import ADDRESS_FIELDS, compile_templates, iter_place_addresses
+
+try:
+    _trans = glocale.get_addon_translator(__file__)
+except ValueError:
+    _trans = glocale.translation
+_ = _trans.gettext
+
+FIELDS = ['id', 'name', 'type'] + ADDRESS_FIELDS + ['latitude', 'longitude']
+
+# templates of the address fields, with the postal code in a field of its own
+EXPORT_TEMPLATES = ["%street, %custom, %unknown, %building, %department, %farm, %neighborhood",
+                    "%hamlet, %village, %borough, %locality",
+                    "%town, %city, %municipality, %parish",
+                    "%district, %region, %province, %county, %state",
+                    "%country",
+                    "%code"]
+
+
+def csv_row_writer(output):
+    """
+    Write the CSV header to the output and return a function that writes
+    a row.
+    """
+    if sys.version_info[0] >= 3:
+        writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL, lineterminator="\r\n")
+        writer.writerow(FIELDS)
+        return writer.writerow
+
+    # the csv module of Python 2 writes byte strings only
+    buf = io.BytesIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_MINIMAL, lineterminator=b"\r\n")
+
+    def write_row(row):
+        writer.writerow([value.encode("utf-8") for value in row])
+        output.write(buf.getvalue().decode("utf-8"))
+        buf.seek(0)
+        buf.truncate()
+
+    write_row(FIELDS)
+    return write_row
+
+
+def jsonl_row_writer(output):
+    """
+    Return a function that writes a row to the output as a JSON object.
+    """
+    def write_row(row):
+        output.write(json.dumps(OrderedDict(zip(FIELDS, row)), ensure_ascii=False) + "\n")
+    return write_row
+
+
+class PlaceAddressWriter(UpdateCallback):
+    """
+    Writes the address fields of all the places with the given row writer.
+    Places are read with a cursor and rows go through the buffer of the
+    output file, so memory use doesn't depend on the number of places.
+    """
+
+    def __init__(self, database, user, row_writer, option_box=None):
+        UpdateCallback.__init__(self, user.callback)
+        self.dbase = database
+        self.row_writer = row_writer
+        self.templates = compile_templates(EXPORT_TEMPLATES)
+        if option_box:
+            option_box.parse_options()
+            self.dbase = option_box.get_filtered_database(self.dbase)
+
+    def write_file(self, filename):
+        self.set_total(self.dbase.get_number_of_places())
+        with io.open(filename, 'w', encoding='utf-8', newline='') as output:
+            write_row = self.row_writer(output)
+            for place, fields in iter_place_addresses(self.dbase, self.templates):
+                write_row((place.get_gramps_id(), place.get_name(),
+                           place.get_type().xml_str())
+                          + fields + (place.get_latitude(), place.get_longitude()))
+                self.update()
+        return True
+
+
+def _export(row_writer, database, filename, user, option_box):
+    ret = False
+    try:
+        writer = PlaceAddressWriter(database, user, row_writer, option_box)
+        ret = writer.write_file(filename)
+    except IOError as msg:
+        msg2 = _("Could not create %s") % filename
+        user.notify_error(msg2, msg)
+    except DatabaseError as msg:
+        user.notify_db_error(_("Export failed"), msg)
+    return ret
+
+
+def export_csv(database, filename, user, option_box=None):
+    """
+    External interface used to register with the plugin system.
+    """
+    return _export(csv_row_writer, database, filename, user, option_box)
+
+
+def export_jsonl(database, filename, user, option_box=None):
+    """
+    External interface used to register with the plugin system.
+    """
+    return _export(jsonl_row_writer, database, filename, user, option_box)
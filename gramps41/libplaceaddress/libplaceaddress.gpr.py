@@ -0,0 +1,38 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2015 Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+#------------------------------------------------------------------------
+#
+# Place address library
+#
+#------------------------------------------------------------------------
+
+register(GENERAL,
+    id    = 'libplaceaddress',
+    name  = "libplaceaddress",
+    description =  _("Library for rendering place addresses from the place tree"),
+    version = '0.1.0',
+    gramps_target_version = '4.1',
+    status = STABLE,
+    fname = 'libplaceaddress.py',
+    load_on_reg = True,
+)
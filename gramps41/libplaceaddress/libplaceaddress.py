@@ -0,0 +1,1560 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2015       Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+"""
+Place address library
+
+Splits places into address keys by the place types found in their place
+tree, and renders addresses with format string templates. Used by the
+AddressPreview gramplet and the place address exporters. Doesn't need GTK.
+"""
+from __future__ import unicode_literals
+
+import copy
+from collections import OrderedDict
+from operator import itemgetter
+from weakref import WeakKeyDictionary, proxy
+
+from gramps.gen.lib import PlaceType
+from gramps.gen.lib.date import Today
+from gramps.gen.config import config
+from gramps.gen.proxy.proxybase import ProxyDbBase
+
+# number of places above other places kept in the hierarchy cache
+_HIERARCHY_CACHE_SIZE = 5000
+
+# number of places whose place tree, address and title are kept by PlaceResolver
+_RESOLVED_CACHE_SIZE = 5000
+
+# keys that can be used in address templates
+PLACE_KEYS = ['street', 'department', 'building', 'farm', 'neighborhood', 'hamlet', 'village',
+              'borough', 'locality', 'town', 'city', 'municipality', 'parish', 'district',
+              'region', 'province', 'county', 'state', 'country', 'custom', 'unknown', 'code']
+
+PLACE_TYPES = dict(street=PlaceType.STREET,
+                   department=PlaceType.DEPARTMENT,
+                   building=PlaceType.BUILDING,
+                   farm=PlaceType.FARM,
+                   neighborhood=PlaceType.NEIGHBORHOOD,
+                   hamlet=PlaceType.HAMLET,
+                   village=PlaceType.VILLAGE,
+                   borough=PlaceType.BOROUGH,
+                   locality=PlaceType.LOCALITY,
+                   town=PlaceType.TOWN,
+                   city=PlaceType.CITY,
+                   municipality=PlaceType.MUNICIPALITY,
+                   parish=PlaceType.PARISH,
+                   district=PlaceType.DISTRICT,
+                   province=PlaceType.PROVINCE,
+                   region=PlaceType.REGION,
+                   county=PlaceType.COUNTY,
+                   state=PlaceType.STATE,
+                   country=PlaceType.COUNTRY,
+                   custom=PlaceType.CUSTOM,
+                   unknown=PlaceType.UNKNOWN)
+
+# address fields and their default templates
+ADDRESS_FIELDS = ['address1', 'address2', 'city', 'state', 'country', 'postal_code']
+
+DEFAULT_TEMPLATES = ["%street, %custom, %unknown, %building, %department, %farm, %neighborhood",
+                     "%hamlet, %village, %borough, %locality",
+                     "%code[ %town, %city, %municipality], %parish",
+                     "%district, %region, %province, %county, %state",
+                     "%country",
+                     ""]
+
+
+class PlaceHierarchyCache(object):
+    """
+    Walks the place tree above places like get_location_list does. Name,
+    type, enclosing place and coordinates of the places above are cached,
+    so that the places shared by many places are fetched from the database
+    only once.
+    """
+
+    def __init__(self, db, date=None, size=_HIERARCHY_CACHE_SIZE):
+        self.db = db
+        self.date = date if date is not None else Today()
+        self.size = size
+        self._entries = OrderedDict()
+        # True when all the places are loaded, see load()
+        self.complete = False
+
+    def _make_entry(self, place):
+        """
+        Return (name, type, enclosing place handle, dated, latitude, longitude)
+        of the place, where dated tells if any of the place references has a
+        date.
+        """
+        handle = None
+        dated = False
+        for placeref in place.get_placeref_list():
+            ref_date = placeref.get_date_object()
+            if ref_date.is_empty():
+                handle = placeref.ref
+            else:
+                dated = True
+                if self.date.match(ref_date):
+                    handle = placeref.ref
+        return (place.get_name(), place.get_type(), handle, dated,
+                place.get_latitude(), place.get_longitude())
+
+    def _get_entry(self, handle):
+        if self.complete:
+            return self._entries.get(handle)
+        entry = self._entries.pop(handle, None)
+        if entry is None:
+            place = self.db.get_place_from_handle(handle)
+            if place is None:
+                return None
+            entry = self._make_entry(place)
+        self._entries[handle] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get_entry(self, handle):
+        """
+        Return (name, type, enclosing place handle, dated, latitude,
+        longitude) of the place, or None if there is no such place.
+        """
+        return self._get_entry(handle)
+
+    def load(self, places):
+        """
+        Load all the places, e.g. from a sequential scan of the place table,
+        passing them through for other uses of the same scan. Once all the
+        places are loaded, the cache is complete: it is no longer bounded
+        and places are not read from the database, until it is invalidated
+        or cleared. Other caches of the places, e.g. the resolved places of
+        PlaceResolver, are kept.
+        """
+        PlaceHierarchyCache.clear(self)
+        for place in places:
+            self._entries[place.handle] = self._make_entry(place)
+            yield place
+        self.complete = True
+
+    def trim(self):
+        """
+        Bound the cache again after load(), keeping the most recently used
+        places.
+        """
+        self.complete = False
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def get_hierarchy(self, place):
+        """
+        Return (handle, name, type) of the place and all the places above it
+        in the place tree.
+        """
+        return self._walk(place)[0]
+
+    def _walk(self, place):
+        """
+        Return the place tree of the place like get_hierarchy does, and
+        whether any place reference in it has a date.
+        """
+        entry = self._make_entry(place)
+        hierarchy = [(place.handle, entry[0], entry[1])]
+        dated = entry[3]
+        handle = entry[2]
+        visited = set([place.handle])
+        while handle is not None and handle not in visited:
+            entry = self._get_entry(handle)
+            if entry is None:
+                break
+            visited.add(handle)
+            hierarchy.append((handle, entry[0], entry[1]))
+            dated = dated or entry[3]
+            handle = entry[2]
+        return hierarchy, dated
+
+    def get_coordinates(self, handle):
+        """
+        Return (latitude, longitude) of the place as they are stored, or
+        None if there is no such place.
+        """
+        entry = self._get_entry(handle)
+        if entry is None:
+            return None
+        return entry[4], entry[5]
+
+    def invalidate(self, handles):
+        """
+        Forget the given places, e.g. when they have been edited.
+        """
+        self.complete = False
+        for handle in handles:
+            self._entries.pop(handle, None)
+
+    def clear(self, *args):
+        self.complete = False
+        self._entries.clear()
+
+    def cache_sizes(self):
+        """
+        Return the number of entries in the caches as a dictionary.
+        """
+        return {'places': len(self._entries)}
+
+
+# indexes of the keys in PlaceAddress
+_KEY_INDEX = dict((key, index) for index, key in enumerate(PLACE_KEYS))
+_TYPE_INDEX = dict((int(place_type), _KEY_INDEX[key])
+                   for key, place_type in PLACE_TYPES.items() if place_type)
+_CODE_INDEX = _KEY_INDEX['code']
+
+
+class PlaceAddress(tuple):
+    """
+    Address keys of a place, in the order of PLACE_KEYS. Keys can be read
+    as attributes, and get() lets templates be rendered with the record in
+    place of a dictionary. Being a tuple, it takes less memory than a
+    dictionary of the keys.
+    """
+    __slots__ = ()
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, values)
+
+    @classmethod
+    def from_hierarchy(cls, hierarchy, code=""):
+        """
+        Fill the record from a place tree, like get_main_location does: the
+        topmost place of each type wins, and custom types are ignored.
+
+        :param hierarchy:   (handle, name, type) of the place and the places above it
+        :param code:        Postal code of the place
+        """
+        values = [""] * len(PLACE_KEYS)
+        for handle, name, place_type in hierarchy:
+            index = _TYPE_INDEX.get(int(place_type))
+            if index is not None:
+                values[index] = name or ""
+        values[_CODE_INDEX] = code or ""
+        return tuple.__new__(cls, values)
+
+    def get(self, key, default=None):
+        index = _KEY_INDEX.get(key)
+        if index is None:
+            return default
+        return self[index]
+
+    def replace(self, **values):
+        """
+        Return a copy of the record with the given keys replaced.
+        """
+        new_values = list(self)
+        for key, value in values.items():
+            new_values[_KEY_INDEX[key]] = value
+        return tuple.__new__(PlaceAddress, new_values)
+
+    def place_names(self):
+        """
+        Return the names of the place tree, without the postal code.
+        """
+        return self[:_CODE_INDEX] + self[_CODE_INDEX + 1:]
+
+    def as_dict(self):
+        return dict(zip(PLACE_KEYS, self))
+
+    def __repr__(self):
+        return "PlaceAddress(%s)" % ", ".join("%s=%r" % (key, value)
+                                              for key, value in zip(PLACE_KEYS, self) if value)
+
+for _key, _index in _KEY_INDEX.items():
+    setattr(PlaceAddress, _key, property(itemgetter(_index)))
+del _key, _index
+
+
+def get_place_address(place, hierarchy):
+    """
+    Return the address keys of the place as a PlaceAddress.
+
+    :param place:       The place
+    :param hierarchy:   The place tree of the place from PlaceHierarchyCache.get_hierarchy()
+    """
+    return PlaceAddress.from_hierarchy(hierarchy, place.get_code())
+
+
+# place types that the place displayer can restrict titles to
+_POPULATED_PLACE_TYPES = frozenset([PlaceType.HAMLET, PlaceType.VILLAGE,
+                                    PlaceType.TOWN, PlaceType.CITY])
+
+
+def get_place_title(hierarchy, get_stored_title):
+    """
+    Return the title of a place from its place tree, like the place displayer
+    does, so that the places above it are not read from the database again.
+    When titles are not generated from the place tree, the stored title is
+    read with get_stored_title(handle).
+
+    :param hierarchy:           (handle, name, type) of the place and the places above it
+    :param get_stored_title:    Function that returns the stored title of a place by handle
+    """
+    hierarchy = list(hierarchy)
+    if not config.get('preferences.place-auto'):
+        return get_stored_title(hierarchy[0][0])
+    restrict = config.get('preferences.place-restrict')
+    if restrict > 0:
+        populated = None
+        for index, (handle, name, place_type) in enumerate(hierarchy):
+            if int(place_type) in _POPULATED_PLACE_TYPES:
+                populated = index
+        if populated is not None:
+            if restrict == 1:
+                hierarchy = hierarchy[:populated + 1]
+            else:
+                hierarchy = hierarchy[populated:]
+    names = [name for handle, name, place_type in hierarchy]
+    if config.get('preferences.place-reverse'):
+        names.reverse()
+    return ", ".join(names)
+
+
+class ResolvedPlace(object):
+    """
+    Place tree of a place, and the address and title resolved from it
+    when they are first needed.
+    """
+    __slots__ = ('hierarchy', 'dated', 'address', 'title')
+
+    def __init__(self, hierarchy, dated):
+        self.hierarchy = hierarchy
+        self.dated = dated
+        self.address = None
+        self.title = None
+
+
+class PlaceResolver(PlaceHierarchyCache):
+    """
+    Resolves place trees, addresses, titles and coordinates of places at
+    the current date, and caches them. Use get_place_resolver() to get the
+    resolver shared by all users of a database: it is invalidated by the
+    place-update and place-delete signals of the database.
+    """
+
+    def __init__(self, db, size=_RESOLVED_CACHE_SIZE):
+        PlaceHierarchyCache.__init__(self, db)
+        self.resolved_size = size
+        # path of the family tree the cached places are from
+        self.path = None
+        # place handle -> ResolvedPlace
+        self._resolved = OrderedDict()
+        # reverse index: handle of a place -> handles of the resolved places
+        # that have it in their place tree
+        self._dependents = {}
+
+    def resolve(self, place):
+        """
+        Return the ResolvedPlace of the place.
+        """
+        resolved = self._resolved.pop(place.handle, None)
+        if resolved is None:
+            hierarchy, dated = self._walk(place)
+            resolved = ResolvedPlace(tuple(hierarchy), dated)
+            for handle, name, place_type in hierarchy:
+                self._dependents.setdefault(handle, set()).add(place.handle)
+        self._resolved[place.handle] = resolved
+        if len(self._resolved) > self.resolved_size:
+            handle, evicted = self._resolved.popitem(last=False)
+            self._remove_dependencies(handle, evicted)
+        return resolved
+
+    def _remove_dependencies(self, place_handle, resolved):
+        for handle, name, place_type in resolved.hierarchy:
+            dependents = self._dependents.get(handle)
+            if dependents is not None:
+                dependents.discard(place_handle)
+                if not dependents:
+                    del self._dependents[handle]
+
+    def get_hierarchy(self, place):
+        """
+        Return (handle, name, type) of the place and all the places above it
+        in the place tree.
+        """
+        resolved = self._resolved.get(place.handle)
+        if resolved is not None:
+            return list(resolved.hierarchy)
+        return PlaceHierarchyCache.get_hierarchy(self, place)
+
+    def is_dated(self, place):
+        """
+        Return True if any place reference in the place tree of the place
+        has a date, i.e. if the place tree may be different at other dates.
+        """
+        return self.resolve(place).dated
+
+    def get_address(self, place):
+        """
+        Return the address keys of the place as a PlaceAddress.
+        """
+        resolved = self.resolve(place)
+        if resolved.address is None:
+            resolved.address = get_place_address(place, resolved.hierarchy)
+        return resolved.address
+
+    def get_title(self, place):
+        """
+        Return the title of the place at the current date, built from the
+        resolved place tree like the place displayer does.
+        """
+        resolved = self.resolve(place)
+        if resolved.title is None:
+            resolved.title = get_place_title(resolved.hierarchy,
+                                             lambda handle: place.get_title())
+        return resolved.title
+
+    def invalidate(self, handles):
+        """
+        Forget the given places and all the places that have them in their
+        place tree. Returns the handles of the forgotten resolved places.
+        """
+        PlaceHierarchyCache.invalidate(self, handles)
+        affected = set()
+        for handle in handles:
+            affected.update(self._dependents.get(handle, ()))
+        for place_handle in affected:
+            resolved = self._resolved.pop(place_handle, None)
+            if resolved is not None:
+                self._remove_dependencies(place_handle, resolved)
+        return affected
+
+    def clear(self, *args):
+        PlaceHierarchyCache.clear(self)
+        self._resolved.clear()
+        self._dependents.clear()
+
+    def cache_sizes(self):
+        sizes = PlaceHierarchyCache.cache_sizes(self)
+        sizes['resolved'] = len(self._resolved)
+        sizes['dependents'] = len(self._dependents)
+        return sizes
+
+
+# place resolvers shared by the users of a database. A resolver only has a
+# weak proxy of its database, otherwise the value would keep the key alive.
+_resolvers = WeakKeyDictionary()
+
+
+def get_place_resolver(db):
+    """
+    Return the place resolver shared by all users of the database. A proxy
+    database gets a resolver of its own, so that places hidden by the proxy
+    can't be resolved from the shared cache.
+    """
+    if isinstance(db, ProxyDbBase):
+        return PlaceResolver(db)
+    resolver = _resolvers.get(db)
+    if resolver is None:
+        resolver = PlaceResolver(proxy(db))
+        db.connect('place-update', resolver.invalidate)
+        db.connect('place-delete', resolver.invalidate)
+        db.connect('place-rebuild', resolver.clear)
+        _resolvers[db] = resolver
+    # the same database object is reused when another family tree is loaded
+    path = db.get_save_path()
+    if resolver.path != path:
+        resolver.clear()
+        resolver.path = path
+    return resolver
+
+
+def validate_template(template):
+    """
+    Check that the enclosing brackets of an address template are balanced
+    and properly nested. Escaped brackets are ignored.
+    """
+    pairs = {']': '[', '>': '<', '}': '{'}
+    stack = []
+    escaped = False
+    for c in template:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in "[<{":
+            stack.append(c)
+        elif c in pairs:
+            if not stack or stack.pop() != pairs[c]:
+                return False
+    return not stack
+
+
+def compile_templates(templates=None):
+    """
+    Compile address templates for rendering with render_address().
+    The default templates are used if no templates are given.
+    """
+    parser = FormatStringParser(list(PLACE_KEYS))
+    return [parser.compile(template) for template in templates or DEFAULT_TEMPLATES]
+
+
+def render_address(place_address, compiled_templates):
+    """
+    Return the address fields of a PlaceAddress or LazyValues as a tuple.
+    """
+    return tuple(compiled_template.render(place_address)
+                 for compiled_template in compiled_templates)
+
+
+def referenced_keys(compiled_templates):
+    """
+    Return the keys referenced in any of the compiled templates.
+    """
+    return frozenset().union(*[compiled_template.keys for compiled_template in compiled_templates])
+
+
+class LazyValues(object):
+    """
+    Values for rendering templates that are computed only when a template
+    reaches their keys, by calling the provider function of the key once.
+    """
+    __slots__ = ('_providers', '_values')
+
+    def __init__(self, providers):
+        self._providers = providers
+        self._values = {}
+
+    def get(self, key, default=None):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        provider = self._providers.get(key)
+        if provider is None:
+            return default
+        value = self._values[key] = provider()
+        return value
+
+
+def lazy_place_address(place, get_address):
+    """
+    Return LazyValues of the address keys of the place. The postal code is
+    read from the place, and get_address(place) is called to get the other
+    keys only when a template reaches one of them.
+    """
+    address = []
+
+    def provider(key):
+        def get_value():
+            if not address:
+                address.append(get_address(place))
+            return address[0].get(key)
+        return get_value
+
+    providers = dict((key, provider(key)) for key in PLACE_KEYS)
+    providers['code'] = place.get_code
+    return LazyValues(providers)
+
+
+def iter_place_addresses(db, compiled_templates=None, hierarchy_cache=None):
+    """
+    Generator of (place, address fields) of all the places in the database.
+    Places are read with a cursor, so memory use doesn't depend on the
+    number of places. The place resolver of the database is used if no
+    hierarchy cache is given.
+    """
+    if compiled_templates is None:
+        compiled_templates = compile_templates()
+    if hierarchy_cache is None:
+        hierarchy_cache = get_place_resolver(db)
+    # the place tree is not walked if the templates only use the postal code
+    tree_keys = referenced_keys(compiled_templates) - frozenset(['code'])
+    for place in db.iter_places():
+        hierarchy = hierarchy_cache.get_hierarchy(place) if tree_keys else ()
+        place_address = get_place_address(place, hierarchy)
+        yield place, render_address(place_address, compiled_templates)
+
+
+# FORMAT STRING PARSER
+# v0.8.1
+#
+# Parses format string with key coded values in dictionary removing unnecessary separators between parsed names
+#
+# (C) 2015  Kati Haapamaki
+#
+# ToDo:
+# methods to change default enclosing chars
+
+
+"""
+    FORMAT STRING PARSER
+
+    Parses a format string by replacing keywords with string values provided in a dictionary.
+
+    Automatically removes characters between keywords that yields empty values.
+    Parts of format string are processed separately, when they are enclosed by enclosing brackets that are
+    by default [<{}>].
+
+    Enclosing brackets has different meanings:
+        [ ]     ANY enclosure. Any single keyword in square brackets that yields non empty string makes to show contents
+        < >     ALL enclosure. All keywords in angle brackets must yield non empty strings to show contents
+        { }     ALWAYS enclosure. Contents enclosed with braces are always shown, regardless of keyword parsing
+                Can be used to force to show characters
+
+    Option operator:
+        |       Single | character without any spaces around makes only first non empty keyword to be shown
+
+    Binding operator:
+        -+      Binds right, element right is parsed only if element left yields non empty
+        +-      Binds left, element left is parsed only if element right yields non empty
+
+    Other operators: (not implemented)
+        $u      Convert to uppercase
+        $s      Convert to sentence case
+        $t      Convert to title case
+        $l      Convert to lowercase
+        $1      Convert to sentence case byt skipping over preceding numeric characters
+        $2      Convert to title case and capitalize letters after any non alphabetic character
+
+    Example:
+        keys and values =
+            lunch = "lunch"
+            dinner = "dinner"
+            meat = "lamb"
+            rice = ""
+            potatoes = "french fries"
+            vegetables = "carrots and broccoli"
+            extra = ""
+            drink = "sparkling water"
+            dessert = "ice-cream"
+            fruit = "apple"
+            coffee = "black coffee"
+            tea = ""
+
+        format string =
+            <%LUNCH|%DINNER: [$s%meat, %rice|%potatoes, %vegetables, %extra,
+                %drink]>-+[ (Dessert: $s[%dessert|%fruit, %coffee|%tea])]
+        result:
+            LUNCH: Lamb, french fries, carrots and broccoli, sparkling water (Dessert: Ice-cream, black coffee)
+
+        note:
+            fruit keyword yields empty because it's optional with desert and desert has priority as it comes first
+            If both keywords 'lunch' and 'dinner' are empty, the first part (main course) is not shown due to
+            all-enclosure < >, and second part (dessert) is not shown either because it is bound with binding operator
+            -+ to the first part, which is empty.
+"""
+
+class ElementType():
+    KEY = 0
+    SEPARATOR = 2
+    PREFIX = 3
+    SUFFIX = 4
+    PARSED = 1
+    PLAINTEXT = 5
+    OPTIONOPERATOR = 6
+    BINDOPERATOR = 7
+
+
+class Case():
+    NONE = 0
+    UPPERCASE = 1
+    LOWERCASE = 2
+    SENTENCECASE = 3
+    TITLECASE = 4
+    SENTENCECASENUMSKIP = 5
+    TITLECASENUMSKIP = 6
+
+
+class ParseMode():
+    ALWAYS = 0
+    IFANY = 1
+    IFALL = 2
+
+
+class CompiledFormat(object):
+    """
+    Format string compiled by FormatStringParser.compile()
+
+    The tree of a compiled format string is made of tuples and rendering doesn't change the parser,
+    so a compiled format string can be rendered from many threads at once, and pickled to be sent
+    to worker processes.
+    """
+    __slots__ = ('parser', 'tree', 'keys', 'key_order')
+
+    NODE_ELEMENTS = 0
+    NODE_ENCLOSING = 1
+
+    def __init__(self, parser, tree):
+        self.parser = parser
+        self.tree = tree
+        # keys referenced in the format string, in the order they appear
+        key_order = []
+        for key in self._iter_keys(tree):
+            if key not in key_order:
+                key_order.append(key)
+        self.key_order = tuple(key_order)
+        self.keys = frozenset(key_order)
+
+    def _iter_keys(self, node):
+        if node[0] == CompiledFormat.NODE_ENCLOSING:
+            for child in (node[1], node[2], node[4]):
+                for key in self._iter_keys(child):
+                    yield key
+        else:
+            for item, item_type, case in node[1]:
+                if item_type == ElementType.KEY:
+                    yield item[0]
+
+    def __reduce__(self):
+        return CompiledFormat, (self.parser, self.tree)
+
+    def render(self, values):
+        """
+        Renders the compiled format string with values given in key/value dictionary
+        """
+        return self.parser.render(values, self)
+
+    def render_into(self, values, writer):
+        """
+        Renders the compiled format string into a file-like object or a list,
+        see FormatStringParser.render_into()
+        """
+        self.parser.render_into(values, self, writer)
+
+
+class FormatStringParser():
+    """
+    Keys of a parser are kept in a tuple, and neither parse() nor render() changes the parser.
+    Only set_keys() and append_keys() do, so they must not be called while the parser is in use
+    in other threads.
+    """
+    _key_prefix = "%"
+    _enc_any_start = '['
+    _enc_any_end = ']'
+    _enc_all_start = '<'
+    _enc_all_end = '>'
+    _enc_always_start = '{'
+    _enc_always_end = '}'
+    _escape_char = "\\"
+    _optional_operator = '|'
+    _add_right_operator = '-+'
+    _add_left_operator = '+-'
+    _uppercase_operator = "$u"
+    _lowercase_operator = "$l"
+    _sentencecase_operator = "$s"
+    _titlecase_operator = "$t"
+    _sentencecase_numskip_operator = "$1"
+    _titlecasenumskip_operator = "$2"
+
+    def __init__(self, key_list=None):
+        if not key_list:
+            self._set_keys(())
+        else:
+            self.set_keys(key_list)
+
+    def _set_keys(self, keys):
+        self._all_keys = tuple(keys)
+        # keys as they are searched for in format strings
+        self._check_keys = tuple((key, self._key_prefix + key.lower()) for key in self._all_keys)
+
+    def set_keys(self, key_list):
+        """
+
+        :param key_list:    List of keys, or a dictionary of which keys are used
+        :return:
+        """
+        if isinstance(key_list, dict):
+            self._set_keys(key_list.keys())
+        elif isinstance(key_list, (list, tuple, set, frozenset)):
+            self._set_keys(key_list)
+        else:
+            raise TypeError("Incorrect key list type")
+
+    def append_keys(self, key_list):
+        """
+
+        :param key_list:    List of keys, or a dictionary of which keys are used
+        :return:
+        """
+        if isinstance(key_list, (dict, list, tuple, set, frozenset)):
+            self._set_keys(self._all_keys + self._new_keys(key_list))
+
+    def _new_keys(self, key_list):
+        """
+        Returns the keys that the parser doesn't know yet as a tuple
+        """
+        new_keys = []
+        for key in key_list:
+            if not self._has_item(key, self._all_keys) and not self._has_item(key, new_keys):
+                new_keys.append(key)
+        return tuple(new_keys)
+
+    def parse(self, values, format_string):
+        """
+        The main method to get work done. Call it from outside class.
+
+        Keys of the values dictionary that the parser doesn't know are recognized too,
+        but they are not added to the parser.
+
+        :param values:          The dictionary including all keywords to be replaced in the format string
+        :param format_string:   The format string to be parsed
+        :return:                Parsed string
+        """
+        parser = self
+        if isinstance(values, dict):
+            new_keys = self._new_keys(values)
+            if new_keys:
+                parser = copy.copy(self)
+                parser._set_keys(self._all_keys + new_keys)
+        parsed_list = parser._parse_full_format_string(values, format_string)
+        parsed_list = parser._collect(parsed_list)
+        return parser._make_string_from_tuple_list(parsed_list)
+
+    def compile(self, format_string):
+        """
+        Compiles a format string into a template that can be rendered repeatedly with different values,
+        without splitting and searching the format string again. Only the keys known by the parser at
+        the time of compiling are recognized in the format string.
+
+        :param format_string:   The format string to be compiled
+        :return:                CompiledFormat
+        """
+        return CompiledFormat(self, self._compile_full_format_string(format_string))
+
+    def render(self, values, compiled_format):
+        """
+        Renders a compiled format string. The result is the same as parsing the format string
+        with parse()
+
+        :param values:          The dictionary including all keywords to be replaced in the format string
+        :param compiled_format: Format string compiled with compile()
+        :return:                Parsed string
+        """
+        parsed_list = self._render_node(values, compiled_format.tree)
+        parsed_list = self._collect(parsed_list)
+        return self._make_string_from_tuple_list(parsed_list)
+
+    def render_into(self, values, compiled_format, writer):
+        """
+        Renders a compiled format string like render(), but instead of joining the result into
+        a string, writes the fragments of the outermost level one by one to the writer. Enclosed
+        parts still become strings, because they must be known to decide what is shown.
+
+        :param values:          The dictionary including all keywords to be replaced in the format string
+        :param compiled_format: Format string compiled with compile()
+        :param writer:          A file-like object, or a list the fragments are appended to
+        """
+        write = writer.append if isinstance(writer, list) else writer.write
+        parsed_list = self._render_node(values, compiled_format.tree)
+        string_list, any_parsed, first_item_case, shown, case = self._collect_fragments(parsed_list)
+        if not shown:
+            return
+        if first_item_case == Case.SENTENCECASE or first_item_case == Case.SENTENCECASENUMSKIP \
+                or any(self._escape_char in fragment for fragment in string_list):
+            # the whole string is needed to do these
+            parsed_string = self._finish_string("".join(string_list), first_item_case)
+            if parsed_string:
+                write(parsed_string)
+        else:
+            for fragment in string_list:
+                if fragment:
+                    write(fragment)
+
+    def _compile_full_format_string(self, format_string, mode=ParseMode.IFANY, case=Case.NONE):
+        """
+        Does the same recursion as _parse_full_format_string, but instead of parsing keys,
+        stores the split format string in a tree of nodes:
+            (NODE_ENCLOSING, before node, middle node, enclosed mode, after node)
+                or
+            (NODE_ELEMENTS, tuple list of elements, case)
+
+        :param format_string:
+        :param mode:
+        :param case:
+        :return:                The root node
+        """
+        format_string, case, sentence_case = self._get_case_operator(format_string, case)
+
+        enclosing_start = self._find_enclosing_start(format_string)
+        if enclosing_start:
+            start_pos = enclosing_start[0]
+
+            if start_pos >= 0:
+                enclosing_end = self._find_enclosing_end(format_string, enclosing_start)
+                if enclosing_end:
+                    end_pos = enclosing_end[0]
+                    enclosed_mode = enclosing_end[1]
+                    before = format_string[:start_pos] if start_pos > 0 else ""
+                    middle = format_string[start_pos + 1:end_pos] if end_pos - start_pos >= 2 else ""
+                    after = format_string[end_pos + 1:] if end_pos < len(format_string) - 1 else ""
+
+                    return (CompiledFormat.NODE_ENCLOSING,
+                            self._compile_full_format_string(before, mode, sentence_case),
+                            self._compile_full_format_string(middle, enclosed_mode, case),
+                            enclosed_mode,
+                            self._compile_full_format_string(after, mode, case))
+
+        return (CompiledFormat.NODE_ELEMENTS,
+                tuple(self._split_format_string_into_tuple_list(format_string, sentence_case)),
+                sentence_case)
+
+    def _render_node(self, values, node):
+        """
+        Parses keys in a compiled node and collects enclosed parts like _parse_full_format_string does
+
+        :param values:
+        :param node:
+        :return:                Tuple list
+        """
+        if node[0] == CompiledFormat.NODE_ENCLOSING:
+            return self._render_node(values, node[1]) \
+                + self._collect(self._render_node(values, node[2]), node[3]) \
+                + self._render_node(values, node[4])
+        return self._parse_keys_in_list(values, list(node[1]), node[2])
+
+    def _get_case_operator(self, format_string, case):
+        """
+        Strips case operator from the beginning of the format string
+
+        :param format_string:
+        :param case:            Inherited case
+        :return:                Tuple of format string, case and case for elements before enclosures
+        """
+        new_case = Case.NONE
+        if format_string:
+                c = format_string[0:2]
+                if c == self._uppercase_operator:
+                    new_case = Case.UPPERCASE
+                elif c == self._sentencecase_operator:
+                    new_case = Case.SENTENCECASE
+                elif c == self._sentencecase_numskip_operator:
+                    new_case = Case.SENTENCECASENUMSKIP
+                elif c == self._titlecase_operator:
+                    new_case = Case.TITLECASE
+                elif c == self._titlecasenumskip_operator:
+                    new_case = Case.TITLECASENUMSKIP
+                elif c == self._lowercase_operator:
+                    new_case = Case.LOWERCASE
+                if new_case != Case.NONE:
+                    format_string = format_string[2:]
+                    case = new_case
+
+        if case == Case.SENTENCECASENUMSKIP or case == Case.SENTENCECASE:
+            sentence_case = case
+            case = Case.NONE
+        else:
+            sentence_case = case
+        return format_string, case, sentence_case
+
+    def _has_item(self, item, list_):
+        """
+
+        :param item:
+        :param list_:
+        :return:
+        """
+        for item_in_list in list_:
+            if item == item_in_list:
+                return True
+        return False
+
+    def _parse_full_format_string(self, values, format_string, mode=ParseMode.IFANY, case=Case.NONE):
+        """
+        Recurses format string's enclosed parts, and parses them into tuple list.
+        Returns tuple list of elements of partial format string when going through recursion
+        Finally returns tuple list that is suppressed to single item including the full parsed string
+
+        :param values:
+        :param format_string:
+        :param mode:
+        :return:
+        """
+        format_string, case, sentence_case = self._get_case_operator(format_string, case)
+
+        enclosing_start = self._find_enclosing_start(format_string)
+        if enclosing_start:
+            start_pos = enclosing_start[0]
+
+            if start_pos >= 0:
+                enclosing_end = self._find_enclosing_end(format_string, enclosing_start)
+                if enclosing_end:
+                    end_pos = enclosing_end[0]
+                    enclosed_mode = enclosing_end[1]
+                    # Divide in parts. Middle is part that is enclosed with brackets, 'before' and 'after' are around it
+                    before = format_string[:start_pos] if start_pos > 0 else ""
+                    middle = format_string[start_pos + 1:end_pos] if end_pos - start_pos >= 2 else ""
+                    after = format_string[end_pos + 1:] if end_pos < len(format_string) - 1 else ""
+
+                    #print("//" + before + "//" + middle + "//" + after + "//")
+                    recursion = self._parse_full_format_string(values, before, mode, sentence_case) \
+                        + self._collect(self._parse_full_format_string(values, middle, enclosed_mode, case),
+                                        enclosed_mode) \
+                        + self._parse_full_format_string(values, after, mode, case)
+
+                    return recursion
+
+        new_tuple_list = self._parse_format_into_list(values, format_string, sentence_case)
+
+        return new_tuple_list
+
+    def _parse_format_into_list(self, values, format_string, case=Case.NONE):
+        """
+        Splits format string into tuple list, and then parses keys included in it
+
+
+        :param values:          Values to be parsed in key/value dictionary
+        :param format_string:   The format string to be parsed
+        :return:                The format string splitted into elements in a list containing tuples
+        """
+        tuple_list = self._split_format_string_into_tuple_list(format_string, case)
+        parsed_list = self._parse_keys_in_list(values, tuple_list, case)
+        return parsed_list
+
+    def _split_format_string_into_tuple_list(self, format_string, case=Case.NONE):
+        """
+        Splits format string into tuple list
+
+        :param format_string:   The format string to be parsed
+        :return:                The format string splitted into elements in a list containing tuples
+
+
+        Tuples has format:
+            ((key as string, formatted key as string), item type as ElementType, case as Case) ...for key element
+                or
+            (item as string, item type as ElementType, case as Case) ...for separators, operators and parsed keys
+
+        case is for case conversion, and it will be passed along to be able to make case conversion at correct point
+
+        """
+        tuple_list = []
+        remainder = format_string
+        any_key_found = False
+        if remainder:
+            while remainder:
+                next_key = self._get_next_key(remainder)
+                if next_key:
+                    before, formatted_key, after = remainder.partition(self._key_prefix + next_key[1])
+                    if before:
+                        if before == self._optional_operator:
+                            separator_tuple = (before, ElementType.OPTIONOPERATOR, case)
+                        elif before == self._add_right_operator or before == self._add_left_operator:
+                            separator_tuple = (before, ElementType.BINDOPERATOR, case)
+                        else:
+                            if any_key_found:
+                                separator_tuple = (before, ElementType.SEPARATOR, case)
+                            else:
+                                separator_tuple = (before, ElementType.PREFIX, case)
+
+                        tuple_list.append(separator_tuple)
+
+                    key_tuple = (next_key, ElementType.KEY, case)
+                    tuple_list.append(key_tuple)
+                    any_key_found = True
+                    remainder = after
+                else:
+                    if remainder == self._optional_operator:
+                        separator_tuple = (remainder, ElementType.OPTIONOPERATOR, case)
+                    elif remainder == self._add_right_operator or remainder == self._add_left_operator:
+                        separator_tuple = (remainder, ElementType.BINDOPERATOR, case)
+                    else:
+                        if any_key_found:
+                            separator_tuple = (remainder, ElementType.SUFFIX, case)
+                        else:
+                            separator_tuple = (remainder, ElementType.PLAINTEXT, case)
+
+                    tuple_list.append(separator_tuple)
+                    remainder = ""
+
+        return tuple_list
+
+    def _get_next_key(self, format_string):
+        """
+        Searches for the first key in a format string
+
+        Search is case-insensitive and because of that, the method returns a tuple of which first item is
+        the key in format that it is appears in the key list, and the second item is the key in format it
+        appears in the format string
+
+        If no key is found, the method returns None
+
+        :param format_string:   The format string
+        :return:                A tuple of the next key and its formatted version
+        """
+        any_found = False
+        lowest_index = -1
+        found_formatted_key = ""
+        found_true_key = ""
+        check_string = format_string.lower()
+
+        if format_string:
+            for key, check_key in self._check_keys:
+                found_pos = check_string.find(check_key, 0)
+                if found_pos >= 0 and (found_pos < lowest_index or not any_found):
+                    char_before = format_string[found_pos-1] if found_pos > 0 else ""
+                    if char_before != self._escape_char:
+                        lowest_index = found_pos
+                        any_found = True
+                        found_true_key = key
+                        found_formatted_key = format_string[lowest_index:lowest_index+len(check_key)]
+        if any_found:
+            return found_true_key, found_formatted_key[len(self._key_prefix):]
+        else:
+            return None
+
+    def _parse_keys_in_list(self, values, tuple_list, inherited_case=Case.NONE):
+        """
+        Parses all the keys in the tuple list by using values given in key/value dictionary
+        Also does case conversion if needed, but not the sentence case conversion, because that cannot be done yet
+
+        :param values:
+        :param tuple_list:
+        :param inherited_case:
+        :return:
+        """
+        if len(tuple_list) < 1:
+            return []
+        new_list = []
+        index = 0
+        option_found = False    # if any key in the current chain of options yields non empty
+
+        #case_from_formatting = Case.NONE
+        #cases = [Case.NONE, Case.UPPERCASE, Case.SENTENCECASE, Case.LOWERCASE]
+
+        for item_master, item_type, case in tuple_list:
+            if type(item_master) is tuple:                  # item_master may be a tuple or just a string
+                item = item_master[0]                           # actual key
+                item_formatted = item_master[1]                 # formatted key
+            else:
+                item = item_formatted = item_master         # not a key (formatted key concept doesn't apply here)
+
+            if case == Case.NONE:
+                case = inherited_case
+
+            if item_type is not ElementType.KEY:
+                if case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
+                    parsed_value = (item, item_type, case)      # Cannot make sentence case op yet. Leave it for later
+                else:
+                    parsed_value = (self._convert_case(item, case), item_type, case)
+
+                new_list.append(parsed_value)
+            else:
+                in_option_chain = index >= 2 and tuple_list[index-1][1] == ElementType.OPTIONOPERATOR \
+                    and tuple_list[index-2][1] == ElementType.KEY
+                if in_option_chain and option_found:
+                    # an earlier option yields non empty, so this key will be left out by the operator
+                    # and its value is not needed
+                    value = ""
+                else:
+                    value = values.get(item)                        # get value for key and set to "" if not existing
+                    if callable(value):                             # value provider is called only when needed
+                        value = value()
+                    if not value:
+                        value = ""
+                    if in_option_chain:
+                        option_found = bool(value)
+                    else:
+                        # the first key of the chain can be left out by a binding operator before it
+                        option_found = bool(value) and \
+                            (index == 0 or tuple_list[index-1][1] != ElementType.BINDOPERATOR)
+
+                case_from_formatting = self._get_case(item_formatted)  # key's case as it appears in the format string
+                if item == item_formatted:                          # if no case difference between actual key
+                    case_from_formatting = Case.NONE                # and formatted key, set tag case conversion to none
+
+                if case_from_formatting != Case.NONE:               # if formatting defines case conversion, use it
+                    case = case_from_formatting                     # instead of using inherited case
+
+                if case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
+                    # parse, but leave sentence case operation for later
+                    parsed_value = (value, ElementType.PARSED, case)
+                else:
+                    # parse and make case conversion
+                    parsed_value = (self._convert_case(value, case), ElementType.PARSED, case)
+                new_list.append(parsed_value)
+
+            index += 1
+
+        return new_list
+
+    def _convert_case(self, string, case):
+        """
+
+        :param string:
+        :param case:
+        :return:
+        """
+        if not string:
+            return ""
+
+        if case == Case.UPPERCASE:
+            return string.upper()
+        elif case == Case.LOWERCASE:
+            return string.lower()
+        elif case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
+            pos = self._find_first_alphanum(string) if case == Case.SENTENCECASE else self._find_first_alpha(string)
+            if pos >= 0:
+                before = string[:pos] if pos > 0 else ""
+                after = string[pos+1:] if len(string) > pos + 1 else ""
+                return before + string[pos].upper() + after
+            else:
+                return string
+        elif case == Case.TITLECASE or case == Case.TITLECASENUMSKIP:
+            prev_c = " "
+            new_string = ""
+            for c in string:
+                if not prev_c.isalnum() and case == Case.TITLECASE\
+                        or prev_c == " " and case == Case.TITLECASENUMSKIP:
+                    new_string = new_string + c.upper()
+                else:
+                    new_string = new_string + c
+                prev_c = c
+            return new_string
+        else:
+            return string
+
+    def _find_first_alphanum(self, string):
+        index = 0
+        if not string:
+            return -1
+        for c in string:
+            if c.isalnum():
+                return index
+            index += 1
+        return -1
+
+    def _find_first_alpha(self, string):
+        index = 0
+        if not string:
+            return -1
+        for c in string:
+            if c.isalpha():
+                return index
+            index += 1
+        return -1
+
+    def _get_case(self, string):
+        cases = [Case.LOWERCASE, Case.UPPERCASE, Case.SENTENCECASE, Case.SENTENCECASENUMSKIP,
+                 Case.TITLECASE, Case.TITLECASENUMSKIP]
+        for case in cases:
+            if string == self._convert_case(string, case):
+                return case
+        return Case.NONE
+
+    def _make_string_from_tuple_list(self, tuple_list):
+        str_list = []
+        for item, mode, case in tuple_list:
+            str_list.append(item)
+        return "".join(str_list)
+
+    def _collect(self, tuple_list, mode=ParseMode.IFANY, case=Case.NONE):
+        """
+        One of they key methods. Suppresses a tuple list to length of 1 by processing all operators and
+        disregarding empty parsed strings and separators between them
+
+        :param tuple_list:  A tuple list
+        :return:            A tuple list with single item
+        """
+        string_list, any_parsed, first_item_case, shown, case = self._collect_fragments(tuple_list, mode, case)
+
+        if shown:
+            parsed_string = self._finish_string("".join(string_list), first_item_case)
+        else:
+            parsed_string = ""
+
+        return[(parsed_string, ElementType.PARSED if any_parsed else ElementType.PLAINTEXT, case)]
+
+    def _collect_fragments(self, tuple_list, mode=ParseMode.IFANY, case=Case.NONE):
+        """
+        Does the work of _collect, but leaves the resulting fragments unjoined
+
+        :param tuple_list:  A tuple list
+        :param mode:        Parse mode of the enclosure
+        :param case:        Case of the result if the tuple list is empty
+        :return:            Tuple of list of fragments, whether any keys were parsed,
+                            case of the first item, whether the fragments are shown by the mode,
+                            and case of the result, which is the case of the last item
+        """
+        string_list = []
+        index = 0
+        any_parsed = False
+
+        # change prefix and suffixes to separators if they are no longer in the beginning or in the end
+        tuple_list = self._fix_separators(tuple_list)
+
+        # process optional and binding operators
+        tuple_list = self._handle_operators(tuple_list)
+        first_item_case = Case.NONE  # will be used if there is need to make case conversion to sentence case
+
+        for item, item_type, case in tuple_list:
+            if index == 0:
+                first_item_case = case
+
+            if item_type == ElementType.PARSED:
+                any_parsed = True
+
+            if (item_type == ElementType.PARSED or item_type == ElementType.PLAINTEXT) and item:
+                string_list.append(item)
+
+                separator1 = separator2 = None
+                found_more = False
+
+                if len(tuple_list) > index + 2:
+                    if tuple_list[index+1][1] == ElementType.SEPARATOR:
+                        separator1 = tuple_list[index + 1]
+                    index2 = index + 1
+
+                    # look for the next parsed value to determine what separators to use
+                    for item2, type2, case2 in tuple_list[index+1:]:
+                        if (type2 == ElementType.PARSED or type2 == ElementType.PLAINTEXT) and item2:
+                            found_more = True
+                            if index2 > index + 2 and tuple_list[index2 - 1][1] == ElementType.SEPARATOR:
+                                separator2 = tuple_list[index2 - 1]
+                            break
+                        index2 += 1
+
+                    separator = separator1 if separator1 else separator2  # prefer using first separator, if two exists
+
+                    if separator and found_more:
+                        string_list.append(separator[0])
+
+            elif item_type == ElementType.SEPARATOR:
+                pass
+
+            elif item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX:
+                string_list.append(item)
+
+            index += 1
+
+        parsed_items = self._number_of_non_empty_parsed_item(tuple_list)
+        empty_items = self._number_of_empty_parsed_item(tuple_list)
+
+        shown = mode == ParseMode.IFANY and parsed_items > 0 \
+            or mode == ParseMode.ALWAYS \
+            or mode == ParseMode.IFALL and parsed_items > 0 and empty_items == 0
+
+        return string_list, any_parsed, first_item_case, shown, case
+
+    def _finish_string(self, parsed_string, first_item_case):
+        """
+        Handles escape characters and sentence case of a collected string
+        """
+        if parsed_string:
+            if parsed_string.find(self._escape_char) >= 0:
+                parsed_string = self._handle_escape_char(parsed_string)
+            # execute sentence case conversion here - later than other conversions,
+            # because we need completely parsed string to do that
+            if first_item_case == Case.SENTENCECASE or first_item_case == Case.SENTENCECASENUMSKIP:
+               parsed_string = self._convert_case(parsed_string, first_item_case)
+        return parsed_string
+
+    def _fix_separators(self, tuple_list):
+        """
+        Should be used to convert suffixes and prefixes that origin from enclosed parts of format string
+        into separators. Must be done before collect/suppress. Working ok?
+
+        :param tuple_list:
+        :return:
+        """
+        index = 0
+        new_tuple_list = []
+        for item, item_type, case in tuple_list:
+            if index > 0 and index < len(tuple_list) - 1 \
+                    and (item_type == ElementType.PREFIX or item_type == ElementType.SUFFIX):
+                new_tuple = (item, ElementType.SEPARATOR, case)
+            else:
+                new_tuple = (item, item_type, case)
+            new_tuple_list.append(new_tuple)
+            index += 1
+        return new_tuple_list
+
+    def _handle_operators(self, tuple_list):
+        skip_next = False
+        index = 0
+        new_tuple_list = []
+        for item, item_type, case in tuple_list:
+            skip_this = False
+            if not skip_next:
+
+                if item_type == ElementType.OPTIONOPERATOR \
+                        and index > 0 and index < len(tuple_list) - 1:
+                    prev_item = new_tuple_list[len(new_tuple_list)-1][0]
+                    prev_item_type = new_tuple_list[len(new_tuple_list)-1][1]
+                    next_item = tuple_list[index+1][0]
+                    next_item_type = tuple_list[index+1][1]
+                    if (prev_item_type == ElementType.PARSED) \
+                            and (next_item_type == ElementType.PARSED):
+                        if not prev_item:
+                            del new_tuple_list[len(new_tuple_list)-1]  # if prev item empty, delete along operator
+                            skip_this = True
+                        else:
+                            skip_next = skip_this = True    # or else omit next, along operator
+                elif item_type == ElementType.BINDOPERATOR:
+                    if item == self._add_right_operator:
+                        if index > 0 and index < len(tuple_list) - 1 \
+                                and not new_tuple_list[len(new_tuple_list)-1][0] \
+                                and new_tuple_list[len(new_tuple_list)-1][1] == ElementType.PARSED \
+                                and tuple_list[index+1][1] == ElementType.PARSED:
+                            skip_next = skip_this = True
+                    if item == self._add_left_operator:
+                        if index > 0 and index < len(tuple_list) - 1 \
+                                and not tuple_list[index+1][0] \
+                                and new_tuple_list[len(new_tuple_list)-1][1] == ElementType.PARSED \
+                                and tuple_list[index+1][1] == ElementType.PARSED:
+                            del new_tuple_list[len(new_tuple_list)-1]
+                            skip_this = True
+                if not skip_this:
+                    new_tuple = (item, item_type, case)
+                    new_tuple_list.append(new_tuple)
+            else:
+                skip_next = False
+            index += 1
+        return new_tuple_list
+
+    def _handle_escape_char(self, string):
+        index = 0
+        new_string = []
+        while index < len(string):
+            if string[index] == self._escape_char:
+                if index < len(string) -1:
+                    if string[index+1] != self._escape_char:
+                        pass
+                    else:
+                        new_string.append(string[index])
+                else:
+                    pass
+            else:
+                new_string.append(string[index])
+            index += 1
+        return "".join(new_string)
+
+    def _number_of_empty_parsed_item(self, tuple_list):
+        """
+
+        :param tuple_list:
+        :return:
+        """
+        counter = 0
+        for item, item_type, case in tuple_list:
+            if item_type == ElementType.PARSED and not item:
+                counter += 1
+        return counter
+
+    def _number_of_non_empty_parsed_item(self, tuple_list):
+        """
+
+        :param tuple_list:
+        :return:
+        """
+        counter = 0
+        for item, item_type, case in tuple_list:
+            if item_type == ElementType.PARSED and item:
+                counter += 1
+        return counter
+
+    def _find_enclosing_start(self, format_string, start_pos=0):
+        """
+
+        :param format_string:
+        :param start_pos:
+        :return:
+        """
+        index = start_pos
+        found_enclosing = None
+        for c in format_string[start_pos:]:
+            if c == self._enc_any_start:
+                found_enclosing = index, ParseMode.IFANY
+            elif c == self._enc_all_start:
+                found_enclosing = index, ParseMode.IFALL
+            elif c == self._enc_always_start:
+                found_enclosing = index, ParseMode.ALWAYS
+            if found_enclosing:
+                if index > start_pos:
+                    if format_string[index-1] == self._escape_char:
+                        found_enclosing = None # omit found enclosing if it's followed by escape char
+                    else:
+                        break
+                else:
+                    break
+
+            index += 1
+
+        return found_enclosing
+
+    def _find_enclosing_end(self, format_string, enclosing_start):
+        """
+
+        :param format_string:
+        :param enclosing_start:
+        :return:
+        """
+        start_pos = enclosing_start[0] + 1
+        found_enclosing_end = None
+
+        if len(format_string)- start_pos > 1:
+
+            mode = enclosing_start[1]
+            if mode == ParseMode.IFALL:
+                ec_end_char = self._enc_all_end
+                ec_start_char = self._enc_all_start
+            elif mode == ParseMode.ALWAYS:
+                ec_end_char = self._enc_always_end
+                ec_start_char = self._enc_always_start
+            else:
+                ec_end_char = self._enc_any_end
+                ec_start_char = self._enc_any_start
+
+            index = start_pos
+            level = 0
+            for c in format_string[start_pos:]:
+                if c == ec_end_char:
+                    if level == 0 and c == ec_end_char:
+                        found_enclosing_end = index, mode
+                        break
+                    else:
+                        level -= 1
+                        if index > start_pos:
+                            if format_string[index-1] == self._escape_char:
+                                level += 1 # was escape, step back
+                elif c == ec_start_char:
+                    level += 1
+                    if index > start_pos:
+                        if format_string[index-1] == self._escape_char:
+                            level -= 1 # was escape, step back
+
+                index += 1
+
+        return found_enclosing_end
+
+    def _is_enclosing_start_char(self, c):
+        """
+
+        :param c:
+        :return:
+        """
+        if not c:
+            return False
+        return c == self._enc_all_start or c == self._enc_any_start or c == self._enc_always_start
+
+    def _is_enclosing_end_char(self, c):
+        if not c:
+            return False
+        return c == self._enc_all_end or c == self._enc_any_end or c == self._enc_always_end
+
+    def _is_enclosing_char(self, c):
+        return self._is_enclosing_start_char(c) or self._is_enclosing_end_char(c)
+
+